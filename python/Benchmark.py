@@ -0,0 +1,392 @@
+# ## What Does This Script Do?
+
+# This script benchmarks the segmentation pipeline on synthetic trajectories, to catch performance regressions.
+#
+# For every point of a scaling curve (over trip length, and over number of trips), it generates a synthetic trajectory
+# dataset, builds the Markov graph from it, transforms the trips and segments some of them, and measures separately the
+# time and peak memory (as traced by `tracemalloc`) of each stage:
+# * `explore_all_transitions`, `obtain_transition_probabilities`, `wedding_cake_probability_regularization` (Building_Graph.py)
+# * `compute_probabilistic_dissimilarities` (Trajectory_Transformation.py)
+# * `calculateDelta`, `dynamicProgramingSegmentation`, `MinimumDescriptionLength` (Dynamic_Programming_Segmentation.py)
+#
+# Alongside the benchmark, output checks run the pipeline on the bundled sample data (`data/segmentation_trips.csv`) and
+# compare the results with `benchmark_reference.json`; use `--update-reference` after an intended change of the outputs.
+# The reference includes digests of the output files (graph, PMD and segmentation), which must be the same as the files
+# written by the original scripts: with `--original-scripts`, these scripts (e.g. extracted from the first version of
+# `python/` with `git show <commit>:python/<script> > <directory>/<script>`) run on the same sample data and their output
+# files are compared too; the reference is only updated when they agree.
+#
+# Results are written as json (see `--output`). Run it from the root of the repository:
+#     python python/Benchmark.py --lengths 50 100 200 --counts 5 10 20
+
+import argparse
+import contextlib
+import hashlib
+import io
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+
+import Building_Graph
+import Columnar_Format
+import Trajectory_Transformation
+import Dynamic_Programming_Segmentation as Segmentation
+
+SAMPLE_DATA = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'data', 'segmentation_trips.csv')
+REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_reference.json')
+GRAPH_FILES = ['prerequisiteFiles/transitionsAdv.csv', 'prerequisiteFiles/probsAdv.csv', 'prerequisiteFiles/probsRegularized.csv']
+PMD_FILE = 'prerequisiteFiles/ProbabilisticDissimilarities.csv'
+SEGMENTATION_FILE = 'output/segmentation_results.csv'
+
+
+# ### Synthetic Trajectories
+
+def generate_trips(output_file, n_trips, trip_length, seed=0):
+    # writes trips in the layout of segmentation_trips.csv (which is also a valid graph_trips.csv); speed changes by
+    # small steps and acceleration follows it, heading change is mostly 0 and otherwise a small multiple of 6 degrees
+    rng = np.random.RandomState(seed)
+    with open(output_file, 'w') as writer:
+        writer.write('TripId,Time_Step,Speed(km/h),Acceleration(m/s^2),Heading_Change(degrees),Latitude,Longitude\n')
+        for t in range(n_trips):
+            speed_change = rng.choice([-3, -2, -1, 0, 1, 2, 3], size=trip_length, p=[.02, .08, .2, .4, .2, .08, .02])
+            speed = np.clip(rng.randint(0, 80) + np.cumsum(speed_change), 0, 140)
+            acceleration = np.round(np.diff(speed, prepend=speed[0]) / 3.6, 2)
+            heading = 6 * np.minimum(rng.geometric(0.75, size=trip_length) - 1, 16)
+            lat = 39.98 + np.cumsum(rng.normal(0, 1e-4, size=trip_length))
+            lng = -83.03 + np.cumsum(rng.normal(0, 1e-4, size=trip_length))
+            for i in range(trip_length):
+                writer.write('S-{},{},{},{},{},{},{}\n'.format(t+1, i+1, speed[i], acceleration[i], heading[i], lat[i], lng[i]))
+
+@contextlib.contextmanager
+def workspace(trips_file):
+    # a temporary directory with the layout expected by the scripts (data/, prerequisiteFiles/, output/)
+    cwd = os.getcwd()
+    path = tempfile.mkdtemp(prefix='segmentation_benchmark_')
+    try:
+        for directory in ('data', 'prerequisiteFiles', 'output'):
+            os.makedirs(os.path.join(path, directory))
+        shutil.copy(trips_file, os.path.join(path, 'data', 'segmentation_trips.csv'))
+        shutil.copy(trips_file, os.path.join(path, 'data', 'graph_trips.csv'))
+        os.chdir(path)
+        yield path
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(path)
+
+
+# ### Measurements
+
+def measure(function, *args, measure_memory=True, **kwargs):
+    # time of a run of function, and peak traced memory of a second run (tracing slows down python code)
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        seconds = time.perf_counter() - start
+
+        peak = None
+        if measure_memory:
+            tracemalloc.start()
+            function(*args, **kwargs)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return result, {'seconds': seconds, 'peak_bytes': peak}
+
+def add_measurement(stages, name, measurement):
+    # accumulates measurements of a stage which runs several times (e.g. once per trip)
+    if name not in stages:
+        stages[name] = {'seconds': 0.0, 'peak_bytes': None, 'calls': 0}
+    stages[name]['seconds'] += measurement['seconds']
+    stages[name]['calls'] += 1
+    if measurement['peak_bytes'] is not None:
+        stages[name]['peak_bytes'] = max(stages[name]['peak_bytes'] or 0, measurement['peak_bytes'])
+
+def run_pipeline(n_trips, trip_length, segmented_trips, max_number_of_segments, measure_memory=True, seed=0):
+    stages = {}
+    trips_file = os.path.join(tempfile.gettempdir(), 'segmentation_benchmark_trips_{}.csv'.format(os.getpid()))
+    generate_trips(trips_file, n_trips, trip_length, seed)
+
+    try:
+        with workspace(trips_file):
+            transitions, m = measure(Building_Graph.explore_all_transitions, measure_memory=measure_memory)
+            add_measurement(stages, 'explore_all_transitions', m)
+            graph, m = measure(Building_Graph.obtain_transition_probabilities, transitions, measure_memory=measure_memory)
+            add_measurement(stages, 'obtain_transition_probabilities', m)
+            regularized, m = measure(Building_Graph.wedding_cake_probability_regularization, graph, measure_memory=measure_memory)
+            add_measurement(stages, 'wedding_cake_probability_regularization', m)
+            _, m = measure(Trajectory_Transformation.compute_probabilistic_dissimilarities, measure_memory=measure_memory)
+            add_measurement(stages, 'compute_probabilistic_dissimilarities', m)
+
+            segmented = 0
+            for trip_id, points, trip_points in Segmentation.read_trips():
+                if segmented == segmented_trips:
+                    break
+                segmented += 1
+                delta, m = measure(Segmentation.calculateDelta, points, measure_memory=measure_memory)
+                add_measurement(stages, 'calculateDelta', m)
+                for Ns in range(1, max_number_of_segments+1):
+                    (I, Index), m = measure(Segmentation.dynamicProgramingSegmentation, points, Ns, delta, measure_memory=measure_memory)
+                    add_measurement(stages, 'dynamicProgramingSegmentation', m)
+                    _, m = measure(Segmentation.MinimumDescriptionLength, points, Index, Ns, measure_memory=measure_memory)
+                    add_measurement(stages, 'MinimumDescriptionLength', m)
+    finally:
+        os.remove(trips_file)
+
+    return {'n_trips': n_trips,
+            'trip_length': trip_length,
+            'graph_states': int(len(np.union1d(regularized.src, regularized.dst))),
+            'graph_transitions': int(len(regularized.src)),
+            'segmented_trips': segmented,
+            'stages': stages}
+
+
+# ### Output Checks on the Sample Data
+
+def write_sample(sample_file, n_trips, trip_length, near_zero_every=None):
+    # the first trip_length records of the first n_trips trips of the sample data; with near_zero_every set, the acceleration ...
+    # ... of every near_zero_every-th record is replaced by -0.1 (which the graph quantizes to a '-0.0' state)
+    counts = {}
+    records = 0
+    with open(SAMPLE_DATA, 'r') as reader, open(sample_file, 'w') as writer:
+        writer.write(next(reader))
+        for line in reader:
+            trip_id = line.split(',')[0]
+            if trip_id not in counts and len(counts) == n_trips:
+                continue
+            counts[trip_id] = counts.get(trip_id, 0) + 1
+            if counts[trip_id] <= trip_length:
+                if near_zero_every is not None and records % near_zero_every == 0:
+                    parts = line.split(',')
+                    parts[3] = '-0.1'
+                    line = ','.join(parts)
+                records += 1
+                writer.write(line)
+
+def graph_outputs(graph, regularized):
+    return {'graph_states': int(len(np.union1d(regularized.src, regularized.dst))),
+            'graph_transitions': int(len(regularized.src)),
+            'graph_probability_sum': float(np.sum(regularized.values)),
+            'quantized_transitions': int(len(graph.src))}
+
+def sample_outputs(n_trips, trip_length, max_number_of_segments):
+    # runs the whole pipeline on the first trips of the sample data, and summarizes its outputs
+    sample_file = os.path.join(tempfile.gettempdir(), 'segmentation_benchmark_sample_{}.csv'.format(os.getpid()))
+    write_sample(sample_file, n_trips, trip_length)
+
+    outputs = {'trips': {}}
+    try:
+        with workspace(sample_file), contextlib.redirect_stdout(io.StringIO()):
+            transitions = Building_Graph.explore_all_transitions(export_debug_files=True)
+            graph = Building_Graph.obtain_transition_probabilities(transitions, export_debug_files=True)
+            regularized = Building_Graph.wedding_cake_probability_regularization(graph)
+            outputs.update(graph_outputs(graph, regularized))
+            # regularization with worker processes must give the same graph, up to the order of summation of the probabilities
+            parallel = Building_Graph.wedding_cake_probability_regularization(graph, output_file=None, workers=2)
+            same_transitions = (np.array_equal(parallel.states, regularized.states) and
+                                np.array_equal(parallel.src, regularized.src) and np.array_equal(parallel.dst, regularized.dst))
+            parallel_difference = float(np.max(np.abs(parallel.values - regularized.values))) if same_transitions else float('inf')
+
+            Trajectory_Transformation.compute_probabilistic_dissimilarities()
+            trips = []
+            with Columnar_Format.CsvTripWriter(SEGMENTATION_FILE, Columnar_Format.SEGMENTATION_LAYOUT) as writer:
+                for trip_id, points, trip_points in Segmentation.read_trips():
+                    segment_points, Ns = Segmentation.segment_trip(trip_id, points, max_number_of_segments)
+                    outputs['trips'][trip_id] = {'pmd_sum': float(np.sum(points)),
+                                                 'pmd_max': float(np.max(points)),
+                                                 'segment_points': segment_points,
+                                                 'Ns': Ns}
+                    Segmentation.write_segmentation(trip_id, trip_points, segment_points, writer)
+                    trips.append((trip_id, points))
+            outputs['files'] = file_digests(GRAPH_FILES + [PMD_FILE, SEGMENTATION_FILE])
+
+            # the other paths must agree with the reference path above
+            outputs['checks'] = {}
+            # windowed segmentation must start a segment at 0, also when the first window is constant (e.g. a parked vehicle)
+            window_size = 2 * max_number_of_segments + 20
+            outputs['checks']['windowed_uncovered_trips'] = sum(
+                Segmentation.segment_trip_windowed(trip_id, signal, max_number_of_segments, window_size, 20)[0][:1] != [0]
+                for trip_id, points in trips for signal in (points, [0.0] * window_size + points))
+            # batched segmentation must give the same results as segment_trip, also for trips of different lengths in a batch
+            signals = [(trip_id, points[:length]) for trip_id, points in trips for length in (len(points), len(points) // 2 + 7)]
+            batched = Segmentation.segment_trip_batch([signal for _, signal in signals], max_number_of_segments)
+            outputs['checks']['batched_mismatched_trips'] = sum(
+                tuple(result) != Segmentation.segment_trip(trip_id, signal, max_number_of_segments)
+                for (trip_id, signal), result in zip(signals, batched))
+            outputs['checks']['parallel_regularization_max_difference'] = parallel_difference
+            # csv outputs must not change through the columnar format
+            outputs['checks']['columnar_round_trip_mismatched_lines'] = (
+                columnar_round_trip_mismatches(PMD_FILE, Columnar_Format.PMD_LAYOUT) +
+                columnar_round_trip_mismatches(SEGMENTATION_FILE, Columnar_Format.SEGMENTATION_LAYOUT))
+
+        # accelerations in [-0.125, 0) give '-0.0' states, distinct from '0.0' states; the sample data has none
+        write_sample(sample_file, n_trips, trip_length, near_zero_every=3)
+        with workspace(sample_file), contextlib.redirect_stdout(io.StringIO()):
+            transitions = Building_Graph.explore_all_transitions(export_debug_files=True)
+            graph = Building_Graph.obtain_transition_probabilities(transitions, export_debug_files=True)
+            outputs['near_zero_accelerations'] = graph_outputs(graph, Building_Graph.wedding_cake_probability_regularization(graph))
+            Trajectory_Transformation.compute_probabilistic_dissimilarities()
+            outputs['near_zero_accelerations']['files'] = file_digests(GRAPH_FILES + [PMD_FILE])
+    finally:
+        os.remove(sample_file)
+    return outputs
+
+def file_digests(paths):
+    # sha256 of every output file, by file name
+    digests = {}
+    for path in paths:
+        with open(path, 'rb') as reader:
+            digests[os.path.basename(path)] = hashlib.sha256(reader.read()).hexdigest()
+    return digests
+
+def original_outputs(scripts, n_trips, trip_length, max_number_of_segments):
+    # digests of the files written by the original scripts (in directory scripts) on the same samples as sample_outputs; ...
+    # ... the original segmentation script hard-codes max_number_of_segments, which is set to the one of the reference
+    sample_file = os.path.join(tempfile.gettempdir(), 'segmentation_benchmark_original_{}.csv'.format(os.getpid()))
+    outputs = {}
+    try:
+        for near_zero_every in (None, 3):
+            write_sample(sample_file, n_trips, trip_length, near_zero_every)
+            with workspace(sample_file) as path:
+                names = ['Building_Graph.py', 'Trajectory_Transformation.py']
+                if near_zero_every is None:
+                    names.append('Dynamic_Programming_Segmentation.py')
+                for name in names:
+                    with open(os.path.join(scripts, name), 'r') as reader:
+                        source = reader.read().replace('max_number_of_segments = 50',
+                                                       'max_number_of_segments = {}'.format(max_number_of_segments))
+                    subprocess.run([sys.executable, '-c', source], cwd=path, check=True, stdout=subprocess.DEVNULL)
+                if near_zero_every is None:
+                    outputs['files'] = file_digests(GRAPH_FILES + [PMD_FILE, SEGMENTATION_FILE])
+                else:
+                    outputs['near_zero_accelerations'] = {'files': file_digests(GRAPH_FILES + [PMD_FILE])}
+    finally:
+        os.remove(sample_file)
+    return outputs
+
+def columnar_round_trip_mismatches(csv_path, layout):
+    # number of lines of csv_path which change after conversion to the columnar format and back
+    path = Columnar_Format.columnar_path(csv_path)
+    round_trip = os.path.splitext(csv_path)[0] + '_round_trip.csv'
+    Columnar_Format.csv_to_columnar(csv_path, path, layout)
+    Columnar_Format.columnar_to_csv(path, round_trip)
+    with open(csv_path, 'r') as expected, open(round_trip, 'r') as actual:
+        return sum(e != a for e, a in itertools.zip_longest(expected, actual))
+
+def compare_outputs(expected, actual, tolerance=1e-9):
+    # returns a list of differences between two summaries of sample outputs
+    differences = []
+    def compare(path, e, a):
+        if isinstance(e, dict):
+            if sorted(e) != sorted(a):
+                differences.append('{}: keys {} != {}'.format(path, sorted(e), sorted(a)))
+                return
+            for key in e:
+                compare(path + '/' + key, e[key], a[key])
+        elif isinstance(e, float):
+            if abs(e - a) > tolerance * max(1.0, abs(e)):
+                differences.append('{}: {} != {}'.format(path, e, a))
+        elif e != a:
+            differences.append('{}: {} != {}'.format(path, e, a))
+    compare('', expected, actual)
+    return differences
+
+def run_checks(update_reference=False, original_scripts=None):
+    with open(REFERENCE, 'r') as reader:
+        reference = json.load(reader)
+    settings = reference['settings']
+    start = time.perf_counter()
+    actual = sample_outputs(settings['n_trips'], settings['trip_length'], settings['max_number_of_segments'])
+    seconds = time.perf_counter() - start
+
+    if original_scripts is not None:
+        # output files must be the same as the ones of the original scripts
+        original = original_outputs(original_scripts, settings['n_trips'], settings['trip_length'], settings['max_number_of_segments'])
+        differences = ['original scripts ' + difference for difference in compare_outputs(
+            original, {'files': actual['files'], 'near_zero_accelerations': {'files': actual['near_zero_accelerations']['files']}})]
+        if differences:
+            return {'passed': False, 'differences': differences, 'seconds': seconds}
+
+    if update_reference:
+        reference['outputs'] = actual
+        with open(REFERENCE, 'w') as writer:
+            json.dump(reference, writer, indent=1, sort_keys=True)
+            writer.write('\n')
+        return {'passed': True, 'updated': True, 'differences': [], 'seconds': seconds}
+
+    differences = compare_outputs(reference['outputs'], actual)
+    return {'passed': not differences, 'differences': differences, 'seconds': seconds}
+
+
+# ### Benchmark Workflow
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark of the trajectory segmentation pipeline on synthetic trips.')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[50, 100, 200], help='trip lengths of the scaling curve over trip length')
+    parser.add_argument('--counts', type=int, nargs='+', default=[10, 20, 40], help='number of trips of the scaling curve over trip count')
+    parser.add_argument('--fixed-count', type=int, default=10, help='number of trips while scaling trip length')
+    parser.add_argument('--fixed-length', type=int, default=100, help='trip length while scaling number of trips')
+    parser.add_argument('--segmented-trips', type=int, default=2, help='number of trips to segment at each point of a curve')
+    parser.add_argument('--max-segments', type=int, default=10, help='max_number_of_segments used for segmentation')
+    parser.add_argument('--no-memory', action='store_true', help='do not measure peak memory (halves the run time)')
+    parser.add_argument('--no-checks', action='store_true', help='skip output checks on the sample data')
+    parser.add_argument('--update-reference', action='store_true', help='store outputs on the sample data as the new reference')
+    parser.add_argument('--original-scripts', help='directory with the original scripts, to check the output files against theirs')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='output/benchmark_results.json', help='json file to write the results to')
+    args = parser.parse_args(argv)
+
+    if 2 * args.max_segments > min(args.lengths + [args.fixed_length]):
+        parser.error('trips must have at least 2 * max-segments points')
+
+    results = {'environment': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform()},
+               'settings': vars(args),
+               'scaling': {'trip_length': [], 'trip_count': []}}
+
+    for trip_length in args.lengths:
+        print ('Benchmarking {} trips of length {} ...'.format(args.fixed_count, trip_length))
+        results['scaling']['trip_length'].append(run_pipeline(args.fixed_count, trip_length, args.segmented_trips,
+                                                              args.max_segments, not args.no_memory, args.seed))
+    for n_trips in args.counts:
+        print ('Benchmarking {} trips of length {} ...'.format(n_trips, args.fixed_length))
+        results['scaling']['trip_count'].append(run_pipeline(n_trips, args.fixed_length, args.segmented_trips,
+                                                             args.max_segments, not args.no_memory, args.seed))
+
+    if not args.no_checks:
+        print ('Checking outputs on the sample data ...')
+        results['checks'] = run_checks(args.update_reference, args.original_scripts)
+
+    output_dir = os.path.dirname(args.output)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(args.output, 'w') as writer:
+        json.dump(results, writer, indent=1)
+
+    # summary
+    for curve, key in (('trip_length', 'trip_length'), ('trip_count', 'n_trips')):
+        print ('\nScaling over {} (seconds):'.format(curve))
+        rows = results['scaling'][curve]
+        if not rows:
+            continue
+        names = list(rows[0]['stages'])
+        print ('{0: <40}'.format('stage') + ''.join('{0: >10}'.format(row[key]) for row in rows))
+        for name in names:
+            print ('{0: <40}'.format(name) + ''.join('{0: >10.3f}'.format(row['stages'][name]['seconds']) for row in rows))
+
+    if 'checks' in results:
+        checks = results['checks']
+        print ('\nOutput checks on the sample data: {}'.format('passed' if checks['passed'] else 'FAILED'))
+        for difference in checks['differences']:
+            print ('  ' + difference)
+    print ('\nResults are written to {}'.format(args.output))
+    return 0 if results.get('checks', {'passed': True})['passed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
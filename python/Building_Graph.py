@@ -2,365 +2,455 @@
 
 # This script uses an input trajectory dataset to create a __Markov Graph__ as described in section 3.2 of the following paper:
 # * [Discovery of Driving Patterns by Trajectory Segmentation](https://arxiv.org/pdf/1804.08748.pdf)
-# 
+#
 # __Input__: a trajectory dataset, where each trajectory is a sequence of record, and each record has the following attributes:
 # * `trip_id` (a string)
 # * `time_step` (an integer)
 # * `speed` (an integer based on km/h)
 # * `acceleration` (a float based on m/s^2)
 # * `heading change` (an integer based on degree)
-# 
-# Intput data must be specified in terms of a single csv file named as `graph_trips.csv`, and the input file must be placed inside `/data` directory. 
-# 
+#
+# Intput data must be specified in terms of a single csv file named as `graph_trips.csv`, and the input file must be placed inside `/data` directory.
+#
 # __Outputs__: this code generates several csv files as output inside `/prerequisiteFiles` directory :
+# * `probsRegularized.csv`: this file contains Markov graph after regularization process
+#
+# The graph flows in memory from one step to the next (counts -> quantized counts -> probabilities -> regularized graph).
+# The intermediate results below are only written when `export_debug_files` is set to True:
 # * `transitionsAdv.csv`: this file contains existing state transitions extracted from `graph_trips.csv`
 # * `probsAdv.csv`: this file contains probability of transitions or the Markov graph
-# * `probsRegularized.csv`: this file contains Markov graph after regularization process
 
 import numpy as np
+import time
+
+from Instrumentation import metrics, run_instrumented
+from Output_Writers import BufferedCsvWriter, as_column
+from Pipeline import pipelined
+
+
+# #### Graph representation shared by all steps
+
+class TransitionGraph:
+    def __init__(self, states, src, dst, values, labels=None):
+        self.states = states  # one row per state: Speed, Acc, Angle
+        self.src = src        # index of the source state of each transition
+        self.dst = dst        # index of the destination state of each transition
+        self.values = values  # frequency or probability of each transition
+        self.labels = labels  # 'Speed&Acc&Angle' label of each state
+
+    def state_labels(self):
+        if self.labels is None:
+            self.labels = ['{}&{}&{}'.format(int(s[0]), s[1], int(s[2])) for s in self.states.tolist()]
+        return self.labels
+
+def unique_in_order(keys):
+    # returns position of first appearance of each distinct key (in order of appearance), and id of each key in that order
+    _, first, inverse = np.unique(keys, return_index=True, return_inverse=True, axis=0 if keys.ndim > 1 else None)
+    order = np.argsort(first, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    return first[order], rank[inverse.reshape(-1)]
+
+def group_by_source(src):
+    # permutation which lists transitions of a source state together, sources and destinations in order of first appearance
+    _, src_rank = unique_in_order(src)
+    return np.argsort(src_rank, kind='stable')
+
+def quarter_states(states, accelNormalizationFactor=0.25):
+    # integer form of quantized states: Speed, Acc as number of bins, Angle, and whether Acc is -0.0. Like the original ...
+    # ... scripts (which key states by their label), accelerations in [-0.125, 0) give a '-0.0' state, distinct from '0.0'
+    bins = np.rint(states[:, 1] / accelNormalizationFactor)
+    negative_zero = (bins == 0) & np.signbit(bins)
+    return np.column_stack((states[:, 0], bins, states[:, 2], negative_zero)).astype(np.int64)
+
+def float_states(quantized, accelNormalizationFactor=0.25):
+    # inverse of quarter_states: Speed, Acc, Angle
+    states = quantized[:, :3].astype(np.float64)
+    states[:, 1] *= accelNormalizationFactor
+    states[quantized[:, 3] == 1, 1] = -0.0
+    return states
+
+def write_transition_graph(graph, output_file, extra_column=None):
+    labels = graph.state_labels()
+    with BufferedCsvWriter(output_file) as writer:
+        src_labels = map(labels.__getitem__, as_column(graph.src))
+        dst_labels = map(labels.__getitem__, as_column(graph.dst))
+        if extra_column is None:
+            writer.write_rows('{},{},{}\n', src_labels, dst_labels, graph.values)
+        else:
+            writer.write_rows('{},{},{},{}\n', src_labels, dst_labels, graph.values, extra_column)
 
 
 # #### First step: explore state transitions in an input set of trajectories
 
-def explore_all_transitions():
-    reader = open('data/graph_trips.csv', 'r')
-    writer = open('prerequisiteFiles/transitionsAdv.csv', 'w')
-
-    transitions = {}
+def explore_all_transitions(input_file='data/graph_trips.csv', export_debug_files=False):
     print ('Started to discover transitions...')
 
-    prevLine = ''
-    crntLine  = ''
-    header = True
-    n_trajectories = set()
-    
-    # obtain and count all transitions
-    for line in reader:
-        line = line.replace('\r','').replace('\n','')
-
-        if header: # skip the header line
-            header = False
-            continue
-
-        if crntLine == '':
-            crntLine = line
-            continue
-
-        prevLine = crntLine
-        crntLine = line
-
-        cParts = prevLine.split(',')
-        nParts = crntLine.split(',')
-        
-        n_trajectories.add(cParts[0])
-
-        try:
-            if cParts[0] == nParts[0]:
-                cTime = int(cParts[1])
-                nTime = int(nParts[1])
+    trip_ids = []
+    time_steps = []
+    labels = []
+    values = []
 
-                cState = cParts[2] + "&" + cParts[3] + "&" + cParts[4]  # Speed&Acc&Angle
-                nState = nParts[2] + "&" + nParts[3] + "&" + nParts[4]  # Speed&Acc&Angle
-
-                if nTime - cTime == 1:
-
-                    destin = {}
-
-                    if cState in transitions:
-                        destin = transitions[cState]
+    # parse records; malformed records are skipped
+    with open(input_file, 'r') as reader:
+        next(reader, None) # skip the header line
+        for line in reader:
+            parts = line.replace('\r','').replace('\n','').split(',')
+            try:
+                value = (float(parts[2]), float(parts[3]), int(parts[4]))  # Speed, Acc, Angle
+                time_steps.append(int(parts[1]))
+            except:
+                continue
+            trip_ids.append(parts[0])
+            labels.append(parts[2] + "&" + parts[3] + "&" + parts[4])  # Speed&Acc&Angle
+            values.append(value)
+
+    trip_ids = np.array(trip_ids)
+    time_steps = np.array(time_steps, dtype=np.int64)
+
+    # a transition is a pair of consecutive records of the same trajectory which are one time step apart
+    consecutive = (trip_ids[:-1] == trip_ids[1:]) & (time_steps[1:] - time_steps[:-1] == 1)
+    first, state_ids = unique_in_order(np.array(labels))
+    cState = state_ids[:-1][consecutive]
+    nState = state_ids[1:][consecutive]
 
-                    if nState in destin:
-                        destin[nState] = destin[nState] + 1
-                    else:
-                        destin[nState] = 1
+    # obtain and count all transitions
+    first_pairs, pair_ids = unique_in_order(cState * len(first) + nState)
+    counts = np.bincount(pair_ids, minlength=len(first_pairs)).astype(np.int64)
+    src = cState[first_pairs]
+    dst = nState[first_pairs]
+    order = group_by_source(src)
 
-                    transitions[cState] = destin
+    transitions = TransitionGraph(np.array(values, dtype=np.float64)[first], src[order], dst[order], counts[order],
+                                  labels=[labels[i] for i in first.tolist()])
 
-        except:
-            pass
+    if export_debug_files:
+        print ('Started to write transitions...')
+        write_transition_graph(transitions, 'prerequisiteFiles/transitionsAdv.csv')
 
-    # write transitions into output file
-    print ('Started to write transitions...')
-    n_trans = 0
-    for f_state in transitions:
-        trans = transitions[f_state]
-        for s_state in trans:
-            writer.write(str(f_state) + ',' + str(s_state) + ',' + str(trans[s_state]) + '\n')
-            n_trans += 1
+    metrics.count('rows_parsed', len(trip_ids))
+    metrics.count('raw_states', len(first))
+    metrics.count('raw_transitions', len(counts))
+    print ('Discovered {} transitions in {} trajectories!'.format(len(counts), len(np.unique(trip_ids))))
+    return transitions
 
-    writer.close()
-    print ('Discovered {} transitions in {} trajectories!'.format(n_trans, len(n_trajectories)))
-    
 
 # #### Second step: obtain state transition probabilities
 
-def obtain_transition_probabilities():
+def obtain_transition_probabilities(transitions, export_debug_files=False):
 
     print ('Started to compute probability values ...')
 
     # set Acceleration bin size
     accelNormalizationFactor = 0.25
 
-    # 0: Reading transition raw values and simplify states by normalizing them using normalization factors (if any)
-    reader = open('prerequisiteFiles/transitionsAdv.csv', 'r')
-    stateTransitionFreq = {}
-    for line in reader:
-        try:
-            parts = line.replace('\r','').replace('\n','').split(',')
-
-            spdAccAngle = parts[0].split('&')
-            crntSpeed = int(float(spdAccAngle[0]))
-            crntAccel = np.round(float(spdAccAngle[1])/accelNormalizationFactor) * accelNormalizationFactor
-            crntAngle = int(spdAccAngle[2])
-
-            spdAccAngle = parts[1].split('&')
-            nxtSpeed = int(float(spdAccAngle[0]))
-            nxtAccel = np.round(float(spdAccAngle[1])/accelNormalizationFactor) * accelNormalizationFactor
-            nxtAngle = int(spdAccAngle[2])
-
-            trans = '{}&{}&{},{}&{}&{}'.format(crntSpeed,crntAccel, crntAngle,nxtSpeed,nxtAccel,nxtAngle)
-
-            if trans in stateTransitionFreq:
-                stateTransitionFreq[trans] = stateTransitionFreq[trans] + int(parts[2])
-            else:
-                stateTransitionFreq[trans] = int(parts[2])
-        except:
-            pass
-
+    # 0: Simplify states by normalizing them using normalization factors (if any), and merge the transitions that become identical
+    raw_states = transitions.states.copy()
+    raw_states[:, 0] = np.trunc(raw_states[:, 0])
+    quantized = quarter_states(raw_states, accelNormalizationFactor)
+    first, quantized_ids = unique_in_order(quantized)
+    states = float_states(quantized[first], accelNormalizationFactor)
+
+    src = quantized_ids[transitions.src]
+    dst = quantized_ids[transitions.dst]
+    first_pairs, pair_ids = unique_in_order(src * len(states) + dst)
+    stateTransitionFreq = np.bincount(pair_ids, weights=transitions.values, minlength=len(first_pairs))
+    src = src[first_pairs]
+    dst = dst[first_pairs]
+    order = group_by_source(src)
+    src, dst, stateTransitionFreq = src[order], dst[order], stateTransitionFreq[order]
 
     # 1: Obtain frequency of each state
-    count = {}
-    for states in stateTransitionFreq:
-        parts = states.split(',')
-
-        if parts[0] != parts[1]:
-            if parts[0] in count:
-                count[parts[0]] = count[parts[0]] + stateTransitionFreq[states]
-            else:
-                count[parts[0]] = stateTransitionFreq[states]
-
+    self_transition = src == dst
+    count = np.bincount(src[~self_transition], weights=stateTransitionFreq[~self_transition], minlength=len(states))
 
     # 2: calculate probability for state transitions
-    probs = {}
-    for states in stateTransitionFreq:
-        parts = states.split(',')
-
-        probsForThisState = {}
-        if parts[0] in probs:
-            probsForThisState = probs[parts[0]]
-
-        if parts[0] != parts[1]:
-            probsForThisState[parts[1]] = float(stateTransitionFreq[states])/count[parts[0]]
-        elif float(parts[0].split('&')[1]) == 0:
-            probsForThisState[parts[1]] = 1.0 # transfer of a state to itself is 1, if acceleration is 0. Otherwise, we should not have no increase/decrease in speed when acceleration is positive/negative
-
-        probs[parts[0]] = probsForThisState
-
+    # transfer of a state to itself is 1, if acceleration is 0. Otherwise, we should not have no increase/decrease in speed when acceleration is positive/negative
+    keep = ~self_transition | (states[src, 1] == 0)
+    probs = np.ones(len(src))
+    np.divide(stateTransitionFreq, count[src], out=probs, where=~self_transition)
 
+    graph = TransitionGraph(states, src[keep], dst[keep], probs[keep])
 
     # 3: print out probability values!
-    writer = open('prerequisiteFiles/probsAdv.csv', 'w')
-    for f_state in probs:
-        for s_state in probs[f_state]:
-            writer.write('{},{},{},{}\n'.format(f_state, s_state, probs[f_state][s_state], count[f_state]))
+    if export_debug_files:
+        write_transition_graph(graph, 'prerequisiteFiles/probsAdv.csv', extra_column=count[graph.src].astype(np.int64))
 
-    writer.close()
-    
+    metrics.count('quantized_states', len(states))
+    metrics.count('transitions', len(graph.src))
     print ('All transition probabilities are calculated!')
+    return graph
 
 
 # #### Third step: Regularization of probability graph
 
-class State:
-    def __init__(self, input):
-        parts = input.split('&')
-        self.speed = int(parts[0])
-        self.accel = float(parts[1])
-        self.heading = int(parts[2])
-
-def wedding_cake_probability_regularization():
-
+def lattice_offsets():
     maxSpeedThreshold = 3    # increase/decrease by steps of size 1.0
     maxAccelThreshold = 0.25 # increase/decrease by steps of size 0.25
     maxHeadingThreshold = 6  # Some updates on heading by steps of size 6.0 ==> this is based on Change of Heading instead of abslute heading
 
     influenceFactorForAccel = 2.0 # This is a relative factor regarding the influence of accel v.s speed to calculate distance between original and updated states
 
-    state2id = {}
-    id2state = {}
-
-    # 1: load probability values
-    print ('Started to load probability values...')
-
-    probs = {}
-    regularizedProbs = {}
-
-    with open('prerequisiteFiles/probsAdv.csv', 'r') as probatility_file:
-        for line in probatility_file:
-            parts = line.split(',')
-
-            if not parts[0] in state2id:
-                s = State(parts[0])
-                state2id[parts[0]] = len(state2id) + 1
-                id2state[state2id[parts[0]]] = s
-            s1 = state2id[parts[0]]
-
-            if not parts[1] in state2id:
-                s = State(parts[1])
-                state2id[parts[1]] = len(state2id) + 1
-                id2state[state2id[parts[1]]] = s
-            s2 = state2id[parts[1]]
-
-            trans1 = {}
-            trans2 = {}
-
-            if s1 in probs:
-                trans1 = probs[s1]
-                trans2 = regularizedProbs[s1]
-
-            trans1[s2] = float(parts[2])
-            trans2[s2] = float(parts[2])
-
-            probs[s1] = trans1
-            regularizedProbs[s1] = trans2
-
-
-    # 2: Normalize probability values
+    s, a, h = np.meshgrid(np.arange(-maxSpeedThreshold, maxSpeedThreshold+1),
+                          np.arange(-maxAccelThreshold, maxAccelThreshold+0.25, 0.25),
+                          np.arange(-maxHeadingThreshold, maxHeadingThreshold+6, 6), indexing='ij')
+    s, a, h = s.ravel(), a.ravel(), h.ravel()
+
+    ## s*a < 0: change in Speed and Acceleration is not in the same direction
+    valid = ~(s*a < 0)
+    s, a, h = s[valid], a[valid], h[valid]
+
+    absoluteDistanceBetweenStates = 1.0 / (np.sqrt(s*s + influenceFactorForAccel*a*a + h*h) + 1) # Adding 1 to further regularize the improvement on probability value
+    return np.column_stack((s, np.rint(a/0.25), h, np.zeros_like(s))).astype(np.int64), absoluteDistanceBetweenStates
+
+def lattice_neighbours(states, src_states, dst_states, offsets):
+    # lattice neighbours of the source or destination states of the transitions, and whether each of them gets an augmentation
+    updated = states[:, None, :] + offsets[None, :, :]
+    updated[:, :, 3] = 0 # an updated acceleration is never -0.0 (e.g. -0.0 + 0.0 == 0.0)
+    ## Negative speed doesn't make any sense
+    ## Negative change of heading does'nt sound.
+    valid = (updated[:, :, 0] >= 0) & (updated[:, :, 2] >= 0)
+    valid &= ~np.all(updated == src_states[:, None, :], axis=2)
+    valid &= ~np.all(updated == dst_states[:, None, :], axis=2)
+    return updated, valid
+
+def regularization_augmentations(src_states, dst_states, probs):
+    # src_states/dst_states are integer states (see quarter_states) of the transitions, probs their probabilities
+    # returns the source, destination and amount of every probability augmentation, whether it also gives its updated source ...
+    # ... a self transition, and its position: transition, updated source (0) or destination (1), lattice offset. Augmentations ...
+    # ... are listed in the order of the original script, i.e. by position.
+    offsets, absoluteDistanceBetweenStates = lattice_offsets()
+
+    # Regularizing by updating the Source
+    updated, valid = lattice_neighbours(src_states, src_states, dst_states, offsets)
+    t, o = np.nonzero(valid)
+    rows = [updated[valid]]
+    cols = [dst_states[t]]
+    positions = [np.column_stack((t, np.zeros_like(t), o))]
+
+    # Regularizing by updating the Destination
+    updated, valid = lattice_neighbours(dst_states, src_states, dst_states, offsets)
+    t, o = np.nonzero(valid)
+    rows.append(src_states[t])
+    cols.append(updated[valid])
+    positions.append(np.column_stack((t, np.ones_like(t), o)))
+
+    positions = np.concatenate(positions)
+    order = np.argsort((positions[:, 0] * 2 + positions[:, 1]) * len(offsets) + positions[:, 2], kind='stable')
+    rows, cols, positions = np.concatenate(rows)[order], np.concatenate(cols)[order], positions[order]
+    probAug = probs[positions[:, 0]] * absoluteDistanceBetweenStates[positions[:, 2]]
+    # Heuristic: if updated acceleration is zero, let's have self transition with probability as 1
+    self_transition = (positions[:, 1] == 0) & (rows[:, 1] == 0)
+    return rows, cols, probAug, self_transition, positions
+
+def normalize_regularized_graph(rows, cols, values, keys):
+    # rows/cols are state codes (see state_codes) of the transitions of the regularized graph, values their probability ...
+    # ... before normalization and keys their serial keys (see partial_regularization). Like the original script, source ...
+    # ... states are listed in the order they are first set, and the destinations of a source in the order they are first set
+    codes, ids = np.unique(np.concatenate((rows, cols)), return_inverse=True)
+    ids = ids.reshape(-1)
+    src, dst = ids[:len(rows)], ids[len(rows):]
+    first_key = np.full(len(codes), np.iinfo(np.int64).max)
+    np.minimum.at(first_key, src, keys)
+    order = np.lexsort((keys, first_key[src]))
+    src, dst, regularizedProbs = src[order], dst[order], values[order]
+    self_transition = src == dst
+    regularizedProbs[self_transition] = 1.0
+
+    # sum up the probabilities of every source state in the order above, like the original script
+    states = code_states(codes)
+    sum = np.bincount(src, weights=regularizedProbs, minlength=len(codes))
+    # We have self transition for zero acceleration. Then, need to subtract 1 from that
+    sum -= states[:, 1] == 0
+
+    probs = np.ones(len(src))
+    np.divide(regularizedProbs, sum[src], out=probs, where=~self_transition)
+
+    # states get ids in order of appearance in the graph
+    first, state_ids = unique_in_order(np.column_stack((src, dst)).reshape(-1))
+    return TransitionGraph(float_states(states[np.column_stack((src, dst)).reshape(-1)[first]]), state_ids[0::2], state_ids[1::2], probs)
+
+# Partitioned regularization: source states are partitioned across worker processes, every worker sums up the original ...
+# ... transitions of its partition and their augmentations per (source, destination) pair, and the partial sums are merged ...
+# ... in the order of the partitions, so the result does not depend on which worker finishes first. Serial regularization ...
+# ... is the same reduction over a single partition, which adds up the values of every pair in the same order as the ...
+# ... original script. Every pair also keeps the serial key where the original script first sets it, so the graph is ...
+# ... listed in the same order whatever the number of partitions; with several partitions, probability values only differ ...
+# ... by the order of summation.
+
+def partition_sources(src, n_partitions):
+    # splits the source states (in order of first appearance) into n_partitions blocks with about the same number of ...
+    # ... transitions; returns the indexes of the transitions of every block, in their original order
+    order = group_by_source(src)
+    _, src_rank = unique_in_order(src)
+    ranks = src_rank[order]
+    cuts = np.searchsorted(ranks, ranks[np.arange(1, n_partitions) * len(src) // n_partitions])
+    return [np.sort(block) for block in np.split(order, np.unique(cuts)) if len(block)]
+
+def partial_regularization(src_states, dst_states, probs, transitions, n_transitions):
+    # the transitions of a partition (transitions are their indexes in the graph of n_transitions transitions) and their ...
+    # ... augmentations, summed up per (source, destination) pair of state codes. The serial key of a value is its position ...
+    # ... in the original script: the original transitions first, then the augmentations by position (see ...
+    # ... regularization_augmentations), each followed by the self transition it gives its updated source, if any.
+    rows, cols, augs, self_transition, positions = regularization_augmentations(src_states, dst_states, probs)
+    n_offsets = len(lattice_offsets()[0])
+    keys = n_transitions + 2 * ((transitions[positions[:, 0]] * 2 + positions[:, 1]) * n_offsets + positions[:, 2])
+
+    rows = state_codes(np.concatenate((src_states, rows, rows[self_transition])))
+    cols = np.concatenate((state_codes(dst_states), state_codes(cols), rows[len(src_states) + len(augs):]))
+    values = np.concatenate((probs, augs, np.zeros(np.count_nonzero(self_transition))))
+    keys = np.concatenate((transitions, keys, keys[self_transition] + 1))
+    return sum_by_pair(rows, cols, values, keys) + (len(augs),)
+
+def state_codes(states):
+    # a single int64 for every integer state (see quarter_states), to group states quickly
+    return (((states[:, 0] + (1 << 20)) << 42) | ((states[:, 1] + (1 << 19)) << 22) | ((states[:, 2] + (1 << 20)) << 1) |
+            states[:, 3])
+
+def code_states(codes):
+    # inverse of state_codes
+    return np.column_stack(((codes >> 42) - (1 << 20), ((codes >> 22) & ((1 << 20) - 1)) - (1 << 19),
+                            ((codes >> 1) & ((1 << 21) - 1)) - (1 << 20), codes & 1))
+
+def sum_by_pair(rows, cols, values, keys):
+    # distinct (row, col) pairs of state codes, the sum of the values of every pair (added in the order of values) and ...
+    # ... its smallest key
+    codes, ids = np.unique(np.concatenate((rows, cols)), return_inverse=True)
+    ids = ids.reshape(-1)
+    _, first, pair_ids = np.unique(ids[:len(rows)] * len(codes) + ids[len(rows):], return_index=True, return_inverse=True)
+    pair_ids = pair_ids.reshape(-1)
+    first_key = np.full(len(first), np.iinfo(np.int64).max)
+    np.minimum.at(first_key, pair_ids, keys)
+    return rows[first], cols[first], np.bincount(pair_ids, weights=values, minlength=len(first)), first_key
+
+def partitioned_regularization(graph, workers=None):
+    # partial_regularization over the partitions of the source states, merged into a single table of pairs. Without ...
+    # ... workers, all the transitions are a single partition, reduced in this process.
+    states = quarter_states(graph.states)
+    blocks = partition_sources(graph.src, workers) if workers is not None else [np.arange(len(graph.src))]
+    partials = [partial for _, partial in pipelined(blocks, partial_regularization,
+                                                    lambda block: (states[graph.src[block]], states[graph.dst[block]], graph.values[block],
+                                                                   block, len(graph.src)),
+                                                    executor='process' if workers is not None else None, workers=workers,
+                                                    queue_depth=len(blocks))]
+    rows, cols, values, keys, n_augmentations = [list(part) for part in zip(*partials)]
+    metrics.count('augmentations', sum(n_augmentations))
+    if len(partials) == 1:
+        return rows[0], cols[0], values[0], keys[0]
+    return sum_by_pair(np.concatenate(rows), np.concatenate(cols), np.concatenate(values), np.concatenate(keys))
+
+def wedding_cake_probability_regularization(graph, output_file='prerequisiteFiles/probsRegularized.csv', top_k=None, mass_threshold=None,
+                                           workers=None):
+
+    # 1: augment probability values of lattice-neighbor sources and destinations of every transition; with workers set, ...
+    # ... source states are partitioned across that many processes
     print ('Started to normalize/regularize probability values...')
-    n_lines = 0;
-
-    for f_state in probs:
-        n_lines += 1.0
-        if len(regularizedProbs)%100 == 0:
-            print ('{0: <12}  #RegularizedStatesWithTransitionsFrom:{1: <10}  #RegularizedStates:{2: <10}'
-                   .format(str(np.round(n_lines*100.0/len(probs), 2)) + '%', len(regularizedProbs), len(state2id)))
-
-        s1 = id2state[f_state]
-        srcSpeed = s1.speed
-        srcAccel = s1.accel
-        srcHead  = s1.heading
-
-        for s_state in probs[f_state]:
-            s2 = id2state[s_state]
-            dstSpeed = s2.speed
-            dstAccel = s2.accel
-            dstHead  = s2.heading
-
-            # Regularizing by updating the Source   
-            for s in range(-maxSpeedThreshold, maxSpeedThreshold+1):
-                for a in np.arange(-maxAccelThreshold, maxAccelThreshold+0.25, 0.25):
-                    for h in range(-maxHeadingThreshold, maxHeadingThreshold+6, 6):
-                        state = '{}&{}&{}'.format(srcSpeed+s, srcAccel+a, srcHead+h)
-
-                        ## s*a < 0: change in Speed and Acceleration is not in the same direction
-                        ## Negative speed doesn't make any sense
-                        ## Negative change of heading does'nt sound.
-                        if s*a<0 or srcSpeed+s<0 or srcHead+h<0:
-                            continue
-
-                        if not state in state2id:
-                            _s = State(state)
-                            state2id[state] = len(state2id) + 1
-                            id2state[state2id[state]] = _s
-                        s3 = state2id[state]
-
-                        if s3==f_state or s3==s_state:
-                            continue
-
-                        absoluteDistanceBetweenStates = 1.0 / (np.sqrt(s*s + influenceFactorForAccel*a*a + h*h) + 1) # Adding 1 to further regularize the improvement on probability value
-                        probAug = probs[f_state][s_state] * absoluteDistanceBetweenStates
-
-                        toTheseStates = {}
-                        if s3 in regularizedProbs:
-                            toTheseStates = regularizedProbs[s3]
-
-                        if s_state in toTheseStates:
-                            toTheseStates[s_state] = toTheseStates[s_state] + probAug
-                        else:
-                            toTheseStates[s_state] = probAug
-
-                        # Heuristic: if updated acceleration is zero, let's have self transition with probability as 1
-                        if srcAccel+a == 0:
-                            toTheseStates[s3] = 1.0
-
-                        regularizedProbs[s3] = toTheseStates
-
-
-            # Regularizing by updating the Destination
-            for s in range(-maxSpeedThreshold, maxSpeedThreshold+1):
-                for a in np.arange(-maxAccelThreshold, maxAccelThreshold+0.25, 0.25):
-                    for h in range(-maxHeadingThreshold, maxHeadingThreshold+6, 6):
-                        state = '{}&{}&{}'.format(dstSpeed+s, dstAccel+a, dstHead+h)
-
-                        ## s*a < 0: change in Speed and Acceleration is not in the same direction
-                        ## Negative speed doesn't make any sense
-                        ## Negative change of heading does'nt sound.
-                        if s*a<0 or dstSpeed+s<0 or dstHead+h<0:
-                            continue
-
-                        if not state in state2id:
-                            _s = State(state)
-                            state2id[state] = len(state2id) + 1
-                            id2state[state2id[state]] = _s
-                        s3 = state2id[state]
+    rows, cols, values, keys = partitioned_regularization(graph, workers)
 
-                        if s3==f_state or s3==s_state:
-                            continue
-
-                        absoluteDistanceBetweenStates = 1.0/(np.sqrt(s*s + influenceFactorForAccel*a*a + h*h) + 1) # Adding 1 to further regularize the improvement on probability value
-                        probAug = probs[f_state][s_state] * absoluteDistanceBetweenStates
-
-                        toTheseStates = regularizedProbs[f_state]
-
-                        if s3 in toTheseStates:
-                            toTheseStates[s3] = toTheseStates[s3] + probAug
-                        else:
-                            toTheseStates[s3] = probAug
-
-                        regularizedProbs[f_state] = toTheseStates
-
-
-    # 3: Print out probability values! for analysis purpose 
-    writer = open('prerequisiteFiles/probsRegularized.csv', 'w')
-    totalRegularizedTransitions = 0
-    totalRegularizedStates = set()
-
-    for f_state in regularizedProbs:
-        
-        totalRegularizedStates.add(f_state)
-        
-        sum = 0
-        for s_state in regularizedProbs[f_state]:
-            sum += regularizedProbs[f_state][s_state]
-            totalRegularizedStates.add(s_state)
-
-        if id2state[f_state].accel == 0:
-            sum -= 1 # We have self transition for this case. Then, need to subtract 1 from that
-
-        s1 = '{}&{}&{}'.format(id2state[f_state].speed, id2state[f_state].accel, id2state[f_state].heading)
-
-        for s_state in regularizedProbs[f_state]:
-            s2 = '{}&{}&{}'.format(id2state[s_state].speed, id2state[s_state].accel, id2state[s_state].heading)
-
-            if f_state != s_state:
-                writer.write('{},{},{}\n'.format(s1, s2, regularizedProbs[f_state][s_state]/sum))
-            else:
-                writer.write('{},{},{}\n'.format(s1, s2, 1.0))
-
-            totalRegularizedTransitions += 1
+    # 2: Normalize probability values
+    regularized = normalize_regularized_graph(rows, cols, values, keys)
+    regularized = prune_transition_graph(regularized, top_k, mass_threshold)
+
+    # 3: Print out probability values! for analysis purpose
+    if output_file is not None:
+        write_transition_graph(regularized, output_file)
+
+    n_states = len(np.union1d(regularized.src, regularized.dst))
+    metrics.count('regularized_states', n_states)
+    metrics.count('regularized_transitions', len(regularized.src))
+    print ('\nNumber of States (or nodes) in Final Markov Graph: ', n_states)
+    print ('Number of Transitions (or edges) in Final Markov Graph: ', len(regularized.src))
+    return regularized
+
+
+# #### Optional pruning of the graph to bound the cost of computing PMD for a record
+
+def prune_transition_graph(graph, top_k=None, mass_threshold=None):
+    # per source state, keep only the top_k most probable successors and/or the smallest set of successors which covers
+    # mass_threshold (e.g. 0.95) of the probability mass. Kept probabilities are renormalized to the mass of the source
+    # state before pruning. Self transitions are always kept, since PMD skips them anyway.
+    if top_k is None and mass_threshold is None:
+        return graph
+
+    self_transition = graph.src == graph.dst
+    candidates = np.flatnonzero(~self_transition)
+    order = candidates[np.lexsort((-graph.values[candidates], graph.src[candidates]))]
+    src = graph.src[order]
+    probs = graph.values[order]
+
+    # rank and cumulative probability of each successor among successors of the same source state
+    is_first = np.r_[True, src[1:] != src[:-1]]
+    first = np.maximum.accumulate(np.where(is_first, np.arange(len(src)), 0))
+    rank = np.arange(len(src)) - first
+    cumulative = np.cumsum(probs)
+    mass_before = cumulative - probs - (cumulative[first] - probs[first])
+    total = np.bincount(src, weights=probs, minlength=len(graph.states))[src]
+
+    keep = np.ones(len(src), dtype=bool)
+    if top_k is not None:
+        keep &= rank < top_k
+    if mass_threshold is not None:
+        keep &= mass_before < mass_threshold * total
+
+    kept_total = np.bincount(src[keep], weights=probs[keep], minlength=len(graph.states))[src]
+    values = graph.values.copy()
+    values[order[keep]] = probs[keep] * total[keep] / kept_total[keep]
+
+    kept = self_transition.copy()
+    kept[order[keep]] = True
+    return TransitionGraph(graph.states, graph.src[kept], graph.dst[kept], values[kept], labels=graph.labels)
+
+def load_transition_graph(input_file='prerequisiteFiles/probsRegularized.csv'):
+    src_labels = []
+    dst_labels = []
+    values = []
+    with open(input_file, 'r') as reader:
+        for line in reader:
+            parts = line.replace('\r','').replace('\n','').split(',')
+            src_labels.append(parts[0])
+            dst_labels.append(parts[1])
+            values.append(float(parts[2]))
 
-    writer.close()
-    print ('\nNumber of States (or nodes) in Final Markov Graph: ', len(totalRegularizedStates))
-    print ('Number of Transitions (or edges) in Final Markov Graph: ', totalRegularizedTransitions)
+    all_labels = src_labels + dst_labels
+    first, state_ids = unique_in_order(np.array(all_labels))
+    labels = [all_labels[i] for i in first.tolist()]
+    states = np.array([label.split('&') for label in labels], dtype=np.float64)
+    return TransitionGraph(states, state_ids[:len(src_labels)], state_ids[len(src_labels):], np.array(values), labels=labels)
 
 
 # ## The Main Process of Building Markov Graph
 
-explore_all_transitions()  # to find all existing state transitions in input trajectory set
-print ('\n')
-obtain_transition_probabilities()  # to find probability of transitions and create transition graph
-print ('\n')
-wedding_cake_probability_regularization() # to regularize transition graph 
-
-
-
+def build_markov_graph(export_debug_files=False, top_k=None, mass_threshold=None, workers=None):
+    stage_times = []
+
+    start = time.time()
+    transitions = explore_all_transitions(export_debug_files=export_debug_files)  # to find all existing state transitions in input trajectory set
+    stage_times.append(('explore_all_transitions', time.time() - start))
+    print ('\n')
+
+    start = time.time()
+    graph = obtain_transition_probabilities(transitions, export_debug_files=export_debug_files)  # to find probability of transitions and create transition graph
+    stage_times.append(('obtain_transition_probabilities', time.time() - start))
+    print ('\n')
+
+    start = time.time()
+    regularized = wedding_cake_probability_regularization(graph, top_k=top_k, mass_threshold=mass_threshold, workers=workers) # to regularize transition graph
+    stage_times.append(('wedding_cake_probability_regularization', time.time() - start))
+
+    print ('\nBuild time per stage:')
+    for stage, seconds in stage_times:
+        metrics.add_time(stage, seconds)
+        print ('{0: <40} {1:.1f} sec'.format(stage, seconds))
+    print ('{0: <40} {1:.1f} sec'.format('total', sum(seconds for _, seconds in stage_times)))
+    return regularized
+
+if __name__ == '__main__':
+    export_debug_files = False # set to True to also write transitionsAdv.csv and probsAdv.csv
+    top_k = None               # set to keep only the top k successors of each state
+    mass_threshold = None      # set (e.g. 0.95) to keep only successors which cover this probability mass of each state
+    workers = None             # set to regularize the graph with this many processes (same graph, up to floating point rounding)
+    metrics_file = None        # set (e.g. 'output/graph_metrics.json') to write timers and counters of the run (see Instrumentation.py)
+    profile_file = None        # set to profile the run, with the profiler below
+    profiler = 'cprofile'      # 'cprofile' or 'sampling'
+
+    run_instrumented(lambda: build_markov_graph(export_debug_files, top_k, mass_threshold, workers), metrics_file, profile_file, profiler)
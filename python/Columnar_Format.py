@@ -0,0 +1,214 @@
+# ## What Does This Script Do?
+
+# This script provides an optional binary columnar format for `ProbabilisticDissimilarities.csv` and `segmentation_results.csv`.
+# A dataset is a directory (e.g. `prerequisiteFiles/ProbabilisticDissimilarities.cols`) with the following files:
+# * `meta.json`: name and type of the columns, number of rows, and the dictionary of trip ids
+# * `TripId.bin`: dictionary-encoded trip id of every row (index in the dictionary of trip ids)
+# * `trip_offsets.bin`: the rows of the i-th trip are the rows `trip_offsets[i]` to `trip_offsets[i+1]-1`
+# * `<column>.bin`: values of a column as a raw little-endian array
+# * `<column>.int_rows.bin` (optional): rows of a float column whose value was written as an integer (e.g. `0` instead of `0.0`),
+#   so that converting back to CSV gives the very same text
+#
+# Readers memory-map the columns, so loading the slice of a single trip does not scan the file.
+# Use `csv_to_columnar` and `columnar_to_csv` to convert from/to the existing CSV layout.
+
+import json
+import os
+import numpy as np
+
+from Output_Writers import BufferedCsvWriter
+
+
+# ### Layout of the CSV files
+
+class Layout:
+    def __init__(self, header, columns):
+        self.header = header   # header line of the CSV file
+        self.columns = columns # (name, dtype) of every column after TripId
+        self.row_format = ','.join(['{}'] * (len(columns) + 1)) + '\n'
+
+PMD_LAYOUT = Layout('TripId,TimeStep,ProbDissimilarity,Lat,Lng,Speed,Acceleration,Heading\n',
+                    [('TimeStep', '<i8'), ('ProbDissimilarity', '<f8'), ('Lat', '<f8'), ('Lng', '<f8'),
+                     ('Speed', '<f8'), ('Acceleration', '<f8'), ('Heading', '<f8')])
+
+SEGMENTATION_LAYOUT = Layout('TripId,TimeStep,Speed,Acceleration,HeadingChange,Latitude,Longitude,PMD,StartOfSegment\n',
+                             [('TimeStep', '<i8'), ('Speed', '<f8'), ('Acceleration', '<f8'), ('HeadingChange', '<f8'),
+                              ('Latitude', '<f8'), ('Longitude', '<f8'), ('PMD', '<f8'), ('StartOfSegment', '|i1')])
+
+
+# ### Writers: both write a trip at a time, given the values of the columns of the layout (in order)
+
+class ColumnarWriter:
+    def __init__(self, path, layout):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.layout = layout
+        self.trip_ids = []
+        self.offsets = [0]
+        self.files = {name: open(os.path.join(path, name + '.bin'), 'wb') for name, _ in layout.columns}
+        self.trip_codes = open(os.path.join(path, 'TripId.bin'), 'wb')
+        self.int_rows = {name: [] for name, dtype in layout.columns if dtype == '<f8'}
+
+    def write_trip(self, trip_id, columns):
+        start = self.offsets[-1]
+        n = len(columns[0])
+        for (name, dtype), values in zip(self.layout.columns, columns):
+            if name in self.int_rows and isinstance(values, list):
+                self.int_rows[name].extend(start + i for i, v in enumerate(values) if type(v) is int)
+            self.files[name].write(np.asarray(values, dtype=dtype).tobytes())
+        self.trip_codes.write(np.full(n, len(self.trip_ids), dtype='<i4').tobytes())
+        self.trip_ids.append(trip_id)
+        self.offsets.append(start + n)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.trip_codes.close()
+        np.asarray(self.offsets, dtype='<i8').tofile(os.path.join(self.path, 'trip_offsets.bin'))
+
+        int_columns = []
+        for name, rows in self.int_rows.items():
+            if rows:
+                np.asarray(rows, dtype='<i8').tofile(os.path.join(self.path, name + '.int_rows.bin'))
+                int_columns.append(name)
+
+        with open(os.path.join(self.path, 'meta.json'), 'w') as meta:
+            json.dump({'header': self.layout.header,
+                       'columns': self.layout.columns,
+                       'rows': self.offsets[-1],
+                       'int_columns': int_columns,
+                       'trip_ids': self.trip_ids}, meta)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class CsvTripWriter:
+    def __init__(self, path, layout):
+        self.layout = layout
+        self.writer = BufferedCsvWriter(path, header=layout.header)
+
+    def write_trip(self, trip_id, columns):
+        self.writer.write_rows(self.layout.row_format, trip_id, *columns)
+
+    def close(self):
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def open_trip_writer(csv_path, layout, output_format='csv'):
+    # output_format is either 'csv' (the existing layout, written to csv_path) or 'columnar' (written next to it, as <name>.cols)
+    if output_format == 'columnar':
+        return ColumnarWriter(columnar_path(csv_path), layout)
+    return CsvTripWriter(csv_path, layout)
+
+def columnar_path(csv_path):
+    return os.path.splitext(csv_path)[0] + '.cols'
+
+
+# ### Reader
+
+class ColumnarReader:
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json'), 'r') as meta:
+            meta = json.load(meta)
+        self.path = path
+        self.header = meta['header']
+        self.columns = [(name, dtype) for name, dtype in meta['columns']]
+        self.rows = meta['rows']
+        self.trip_ids = meta['trip_ids']
+        self.trip_index = {trip_id: i for i, trip_id in enumerate(self.trip_ids)}
+        self.offsets = np.fromfile(os.path.join(path, 'trip_offsets.bin'), dtype='<i8')
+        self.data = {name: self.map(name + '.bin', dtype, self.rows) for name, dtype in self.columns}
+        self.data['TripId'] = self.map('TripId.bin', '<i4', self.rows)
+        self.int_rows = {name: np.fromfile(os.path.join(path, name + '.int_rows.bin'), dtype='<i8') for name in meta['int_columns']}
+
+    def map(self, file_name, dtype, rows):
+        if rows == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, file_name), dtype=dtype, mode='r', shape=(rows,))
+
+    def trip_range(self, trip_id):
+        i = self.trip_index[trip_id]
+        return int(self.offsets[i]), int(self.offsets[i+1])
+
+    def trip(self, trip_id):
+        # values of every column for the rows of a single trip (views on the memory-mapped files)
+        start, end = self.trip_range(trip_id)
+        return {name: self.data[name][start:end] for name, _ in self.columns}
+
+    def trip_values(self, trip_id):
+        # values of a trip as python lists, with integer values restored where they were written as integers
+        start, end = self.trip_range(trip_id)
+        columns = []
+        for name, _ in self.columns:
+            values = self.data[name][start:end].tolist()
+            if name in self.int_rows:
+                rows = self.int_rows[name]
+                for r in rows[np.searchsorted(rows, start):np.searchsorted(rows, end)].tolist():
+                    values[r - start] = int(values[r - start])
+            columns.append(values)
+        return columns
+
+    def __iter__(self):
+        for trip_id in self.trip_ids:
+            yield trip_id, self.trip(trip_id)
+
+    def __len__(self):
+        return len(self.trip_ids)
+
+
+# ### Converters from/to the CSV layout
+
+def parse_value(text, dtype):
+    if dtype == '<f8':
+        try:
+            return int(text)  # keep integer literals, so that the CSV can be written back as it was
+        except ValueError:
+            return float(text)
+    return int(text)
+
+def csv_to_columnar(csv_path, path, layout):
+    with open(csv_path, 'r') as reader, ColumnarWriter(path, layout) as writer:
+        next(reader, None) # skip the header line
+        trip_id = None
+        columns = []
+        for line in reader:
+            parts = line.replace('\r','').replace('\n','').split(',')
+            if parts[0] != trip_id:
+                if trip_id is not None:
+                    writer.write_trip(trip_id, columns)
+                trip_id = parts[0]
+                columns = [[] for _ in layout.columns]
+            for values, text, (_, dtype) in zip(columns, parts[1:], layout.columns):
+                values.append(parse_value(text, dtype))
+        if trip_id is not None:
+            writer.write_trip(trip_id, columns)
+
+def columnar_to_csv(path, csv_path):
+    reader = ColumnarReader(path)
+    layout = Layout(reader.header, reader.columns)
+    with CsvTripWriter(csv_path, layout) as writer:
+        for trip_id in reader.trip_ids:
+            writer.write_trip(trip_id, reader.trip_values(trip_id))
+
+
+if __name__ == '__main__':
+    import sys
+
+    # usage: python Columnar_Format.py to-columnar|to-csv <input> <output> [pmd|segmentation]
+    if len(sys.argv) < 4 or sys.argv[1] not in ('to-columnar', 'to-csv'):
+        print ('usage: python Columnar_Format.py to-columnar|to-csv <input> <output> [pmd|segmentation]')
+        sys.exit(1)
+
+    if sys.argv[1] == 'to-columnar':
+        layout = SEGMENTATION_LAYOUT if len(sys.argv) > 4 and sys.argv[4] == 'segmentation' else PMD_LAYOUT
+        csv_to_columnar(sys.argv[2], sys.argv[3], layout)
+    else:
+        columnar_to_csv(sys.argv[2], sys.argv[3])
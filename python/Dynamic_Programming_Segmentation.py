@@ -25,11 +25,20 @@
 # * `Lng`: longitude coordinate of GPS (a float)
 # * `PMD`: probabilistic movement dissimilarity (or probability dissimilarity) value for the current record of a trajectory (a float). This is the signal value for a record. 
 # * `StartOfSegment`: an indicator that specifies whether a given record is the start of a new segment or not. A value of 1 indicates that a record is start of a new segment. 
+#
+# Both input and output can optionally use the binary columnar format described in `Columnar_Format.py` (see `input_format` and `output_format` below).
 
+import functools
+import itertools
 import numpy as np
 import math
 import time
 
+from Columnar_Format import SEGMENTATION_LAYOUT, ColumnarReader, columnar_path, open_trip_writer
+from Instrumentation import metrics, run_instrumented
+from Pipeline import pipelined
+from Segmentation_Cache import SegmentationCache
+
 e  = math.e
 pi = math.pi
 float_max_value = 1000000.0
@@ -182,6 +191,246 @@ def MinimumDescriptionLength(points, Index, Ns):
     return MDL
 
 
+# ### Batched Segmentation of Short Trajectories
+
+# For short trajectories (up to a few hundred points) most of the time is spent in the python loops above rather than in ...
+# ... arithmetic. The functions below segment a batch of trajectories of similar length at once: the trajectories are padded ...
+# ... to the same length, and delta, the layers of the dynamic programming and the MDL of every Ns are calculated with array ...
+# ... operations over the whole batch. They perform the same floating point operations in the same order as the functions ...
+# ... above, so a trajectory gets exactly the same segmentation whether it is batched or not.
+# Note: python's x**2 and math.pow(x, 2) call the C pow function, which is not always equal to x*x in the last bit; ...
+# ... np.float_power calls pow for every element as well, so it is used wherever the functions above use x**2 or math.pow.
+
+def pow2(x):
+    return np.float_power(x, 2.0)
+
+def calculateDeltaBatch(points):
+    # points: (B, N) array with the probabilistic dissimilarity values of B trajectories, padded to the same length N
+    # delta[b, i, j] is the same as calculateDelta(points of trajectory b)[i][j], for j lower than the length of trajectory b
+    B, N = points.shape
+    delta = np.full((B, N-1, N), float_max_value)
+    sums = points # sums[:, i] is the sum of the segment of length m starting at i, accumulated from left to right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for m in range(2, N+1):
+            starts = np.arange(N-m+1)
+            sums = sums[:, :N-m+1] + points[:, m-1:]
+            mean = sums / m
+            v = np.lib.stride_tricks.sliding_window_view(points, m, axis=1) # v[:, i] = points[:, i:i+m]
+            diff = v - mean[:, :, None]
+            std = np.sqrt(np.cumsum(pow2(diff), axis=2)[:, :, -1] / m)
+            value = np.log(std * np.sqrt(2*pi))[:, :, None] + np.power(diff, 2)/(2*np.power(std, 2))[:, :, None]
+            delta[:, starts, starts+m-1] = np.where(std != 0, np.sum(value, axis=2), 0)
+    return delta
+
+def dynamicProgramingSegmentationBatch(Ns, delta):
+    # I and Index of dynamicProgramingSegmentation for every trajectory of the batch. Layer k of I and Index does not ...
+    # ... depend on Ns, so I[:, :ns] and Index[:, :ns] are the result for any smaller number of segments ns as well.
+    B, N = delta.shape[0], delta.shape[2]
+    I = np.full((B, Ns, N), float_max_value)
+    Index = np.full((B, Ns, N), 0, dtype=int)
+    I[:, 0] = delta[:, 0]
+    for k in range(1, min(Ns, N//2)):
+        # candidates nk_1 = k*2, ..., N-2 (rows) for L = k*2+1, ..., N-1 (columns); only nk_1 < L are allowed
+        C = N-1 - k*2
+        values = I[:, k-1, k*2-1:N-2][:, :, None] + delta[:, k*2:, k*2+1:]
+        values[:, np.tri(C, k=-1, dtype=bool)] = np.inf
+        best = np.argmin(values, axis=1) # first minimum, like the strict comparison of dynamicProgramingSegmentation
+        min_value = np.take_along_axis(values, best[:, None, :], axis=1)[:, 0, :]
+        found = min_value < float_max_value
+        I[:, k, k*2+1:] = np.where(found, min_value, float_max_value)
+        Index[:, k, k*2+1:] = np.where(found, best + k*2, -1)
+    return I, Index
+
+def MinimumDescriptionLengthBatch(points, lengths, Index, Ns):
+    # MinimumDescriptionLength of every trajectory of the batch for the given Ns; trajectories whose segmentation is not ...
+    # ... well formed (e.g. having less than 2*Ns points) are given to MinimumDescriptionLength to get the same result
+    B = len(lengths)
+    rows = np.arange(B)
+    begins = np.zeros((B, Ns), dtype=int) # segments in the order of MinimumDescriptionLength (last segment first)
+    ends = np.zeros((B, Ns), dtype=int)
+    well_formed = np.ones(B, dtype=bool)
+    segment_end = lengths - 1
+    for t, k in enumerate(reversed(range(0, Ns))):
+        segment_begin = Index[rows, k, np.maximum(segment_end, 0)]
+        well_formed &= (segment_end >= 0) & (segment_begin >= 0) & (segment_begin <= segment_end)
+        begins[:, t] = segment_begin
+        ends[:, t] = segment_end
+        segment_end = segment_begin - 1
+
+    sizes = ends - begins + 1
+    offsets = np.arange(max(1, sizes[well_formed].max(initial=1)))
+    x = points[rows[:, None, None], np.minimum(begins[:, :, None] + offsets, points.shape[1]-1)]
+    last = np.maximum(sizes - 1, 0)[:, :, None]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # estimate_mean_std of every segment
+        mean = np.take_along_axis(np.cumsum(x, axis=2), last, axis=2) / sizes[:, :, None]
+        std = np.sqrt(np.take_along_axis(np.cumsum(pow2(x - mean), axis=2), last, axis=2) / sizes[:, :, None])
+
+        # ln_of_normal_distribution of every point of every segment but the last one; it is nan when std is 0
+        log_term = np.array([math.log(s) if s > 0 else np.nan for s in (std * math.sqrt(2 * pi)).ravel().tolist()]).reshape(std.shape)
+        divisor = 2 * pow2(std)
+        divisor[divisor == 0] = np.nan
+        ln = -1 * (log_term + (pow2(x - mean)/divisor))
+        segment_mle = np.take_along_axis(np.cumsum(ln, axis=2), np.maximum(sizes - 2, 0)[:, :, None], axis=2)[:, :, 0]
+        segment_mle[sizes < 2] = 0
+
+    mle = np.cumsum(segment_mle, axis=1)[:, -1]
+    mle *= -1
+    r_k = 2*Ns + Ns - 1
+    MDL = mle + np.array([(r_k/2) * math.log(n) for n in lengths.tolist()])
+
+    for b in np.flatnonzero(~well_formed):
+        n = lengths[b]
+        MDL[b] = MinimumDescriptionLength(points[b, :n].tolist(), Index[b, :Ns, :n], Ns)
+    return MDL
+
+def segment_trip_batch(trips, # list of probabilistic dissimilarity values of every trajectory
+                       max_number_of_segments # the maximum number of segments that we allow
+                      ):
+    # returns the same as segment_trip for every trajectory of the batch
+    lengths = np.array([len(points) for points in trips])
+    padded = np.zeros((len(trips), lengths.max()))
+    for b, points in enumerate(trips):
+        padded[b, :len(points)] = points
+
+    with metrics.timer('calculateDeltaBatch'):
+        delta = calculateDeltaBatch(padded)
+    with metrics.timer('dynamicProgramingSegmentationBatch'):
+        I, Index = dynamicProgramingSegmentationBatch(max_number_of_segments, delta)
+
+    MDL = np.full(len(trips), float_max_value)
+    bestNs = np.full(len(trips), -1)
+    for Ns in range(1, max_number_of_segments+1):
+        with metrics.timer('MinimumDescriptionLengthBatch'):
+            mdl = MinimumDescriptionLengthBatch(padded, lengths, Index, Ns)
+        better = mdl < MDL
+        MDL[better] = mdl[better]
+        bestNs[better] = Ns
+    metrics.count('batched_trips', len(trips))
+
+    results = []
+    for b, n in enumerate(lengths.tolist()):
+        optimizedIndex = Index[b, :, :n]
+        segmentPoints = set()
+        lastEndPoint = n-1
+        for k in reversed(range(bestNs[b])):
+            segmentPoints.add(int(optimizedIndex[k][lastEndPoint]))
+            lastEndPoint = optimizedIndex[k][lastEndPoint] - 1
+        results.append((sorted(segmentPoints), int(bestNs[b])))
+    return results
+
+def length_batches(lengths, min_length=2, max_length=300, length_tolerance=16, batch_cells=1 << 23):
+    # groups the indexes of trajectories of similar length (from min_length to max_length points) into batches, so that ...
+    # ... padding wastes little and a batch of B trajectories padded to N points has at most batch_cells cells of delta (B*N*N)
+    batches = []
+    batch = []
+    for i in sorted(range(len(lengths)), key=lambda i: lengths[i]):
+        if not min_length <= lengths[i] <= max_length:
+            continue
+        if batch and (lengths[i] > lengths[batch[0]] + length_tolerance or (len(batch)+1) * lengths[i]**2 > batch_cells):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+# ### Windowed Segmentation of Long Trajectories
+
+# Delta and the dynamic programming take quadratic memory and (at least) quadratic time in the length of a trajectory, so ...
+# ... they are not feasible for trajectories of several hours. The windowed mode segments such a trajectory in overlapping ...
+# ... windows of window_size points (consecutive windows share overlap points). All windows have the same length, so they ...
+# ... are segmented together with segment_trip_batch. The boundaries are then stitched: in the overlap of two windows, ...
+# ... a boundary is taken from the window in which it is farther from the edge, i.e. the first window up to the middle ...
+# ... of the overlap and the second window after it. This drops the fake boundaries at the edges of the windows. Finally, ...
+# ... adjacent segments are merged as long as this reduces the MDL of the whole segmentation.
+
+def window_starts(n, window_size, overlap):
+    starts = list(range(0, n - window_size, window_size - overlap))
+    return starts + [n - window_size] # the last window ends at the end of the trajectory
+
+def stitch_windows(starts, window_segment_points, window_size):
+    # start points of the segments of the trajectory, given the start points of the segments of every window
+    # the first segment always starts at 0, even if the first window has no segment (e.g. when its PMD is constant, ...
+    # ... segment_trip_batch gives no boundary for it)
+    segmentPoints = [0]
+    for w, (start, points) in enumerate(zip(starts, window_segment_points)):
+        lower = 0 if w == 0 else (start + starts[w-1] + window_size) // 2 # middle of the overlap with the previous window
+        upper = (starts[w+1] + start + window_size) // 2 if w+1 < len(starts) else float('inf')
+        for p in points:
+            p += start
+            # a segment has at least 2 points; this also drops the start of the first window, which is already 0
+            if lower <= p < upper and p - segmentPoints[-1] >= 2:
+                segmentPoints.append(p)
+    return segmentPoints
+
+def segment_log_likelihood(points, segment_begin, segment_end):
+    # thisSegmentMLE of MinimumDescriptionLength for the segment from segment_begin to segment_end
+    mean,std = estimate_mean_std(points[segment_begin:segment_end+1])
+    thisSegmentMLE = 0
+    for i in range(segment_begin,segment_end):
+        thisSegmentMLE += ln_of_normal_distribution(points[i], mean, std)
+    return thisSegmentMLE
+
+def merge_segments_by_mdl(points, segmentPoints):
+    # merges the pair of adjacent segments that reduces MDL the most (see MinimumDescriptionLength), until no merge reduces it
+    begins = list(segmentPoints)
+    ends = [p-1 for p in begins[1:]] + [len(points)-1]
+    mle = [segment_log_likelihood(points, b, e) for b, e in zip(begins, ends)]
+    merged = [None] + [segment_log_likelihood(points, begins[j-1], ends[j]) for j in range(1, len(begins))]
+    penalty = 1.5 * math.log(len(points)) # r_k/2 * ln(N) decreases by 3/2 * ln(N) for each segment less
+
+    while len(begins) > 1:
+        # MDL change when the (j-1)-th and j-th segments are merged; nan never reduces MDL
+        best, best_change = None, 0
+        for j in range(1, len(begins)):
+            change = -(merged[j] - mle[j-1] - mle[j]) - penalty
+            if change < best_change:
+                best, best_change = j, change
+        if best is None:
+            break
+        j = best
+        mle[j-1] = merged[j]
+        ends[j-1] = ends[j]
+        del begins[j], ends[j], mle[j], merged[j]
+        if j-1 >= 1:
+            merged[j-1] = segment_log_likelihood(points, begins[j-2], ends[j-1])
+        if j < len(begins):
+            merged[j] = segment_log_likelihood(points, begins[j-1], ends[j])
+    return begins
+
+def segment_trip_windowed(trip_id, # trip id
+                          points,  # contains probabilistic dissimilarity values
+                          max_number_of_segments, # the maximum number of segments that we allow in every window
+                          window_size=300, # number of points of a window
+                          overlap=100 # number of points shared by consecutive windows
+                         ):
+    # returns the sorted start points of the segments, and the number of segments; trajectories which fit in a window ...
+    # ... are segmented exactly
+    # with less than 2 points of overlap, the middle of the overlap is the start of a window, whose boundary is fake
+    if window_size < 2*max_number_of_segments or not 2 <= overlap < window_size:
+        raise ValueError('window_size must be at least 2*max_number_of_segments, and overlap from 2 to window_size-1')
+    if len(points) <= window_size:
+        return segment_trip(trip_id, points, max_number_of_segments)
+
+    starts = window_starts(len(points), window_size, overlap)
+    with metrics.timer('segment_windows', trip=trip_id):
+        windows = segment_trip_batch([points[s:s+window_size] for s in starts], max_number_of_segments)
+    metrics.count('windows', len(starts), trip=trip_id)
+    with metrics.timer('stitch_windows', trip=trip_id):
+        segmentPoints = stitch_windows(starts, [segmentPoints for segmentPoints, _ in windows], window_size)
+        segmentPoints = merge_segments_by_mdl(points, segmentPoints)
+    metrics.set('Ns', len(segmentPoints), trip=trip_id)
+    return segmentPoints, len(segmentPoints)
+
+def segment_trip_by_strategy(trip_id, points, max_number_of_segments, strategy='exact', window_size=300, overlap=100):
+    # strategy is either 'exact' (segment_trip) or 'windowed' (segment_trip_windowed)
+    if strategy == 'windowed':
+        return segment_trip_windowed(trip_id, points, max_number_of_segments, window_size, overlap)
+    return segment_trip(trip_id, points, max_number_of_segments)
+
+
 # ### Segmentation Workflow
 
 class trip_tuple:
@@ -194,118 +443,311 @@ class trip_tuple:
         self.time_step = int(time_step)
         self.pmd = float(pmd) # probabilistic movement dissimilarity
 
-def segmentation_process(trip_id, # trip id
-                         points,  # contains probabilistic dissimilarity values
-                         trip_points, # contains trip points
-                         max_number_of_segments, # the maximum number of segments that we allow
-                         writer # writer to print output 
-                        ):
+def segment_trip(trip_id, # trip id
+                 points,  # contains probabilistic dissimilarity values
+                 max_number_of_segments # the maximum number of segments that we allow
+                ):
+    # returns the sorted start points of the segments, and the chosen number of segments
     # 1. Calculation of Delta for all form of segments in given trajectory
-    print ('Building delta for {} ... '.format(trip_id), end='')
-    start = time.time()
-    delta = calculateDelta(points)
-    print ('completed in {:.1f} sec!'.format(time.time()-start))
+    with metrics.timer('calculateDelta', trip=trip_id):
+        delta = calculateDelta(points)
+    metrics.count('delta_cells', len(points)*(len(points)-1)//2, trip=trip_id)
     
     # 2. Optimization to find the best value of Ns
     MDL = float_max_value
     bestNs = -1
     optimizedIndex = None
-    print ('Segmenting trajectory {} '.format(trip_id), end=''),
     
-    start = time.time()
     for Ns in range(1, max_number_of_segments+1):
         # 3. Finding optimal segmentation by having N_s as number of existing segments in given trajectory
         # In addition to minimum values, we need minimum indexes which show the best breaking points for segments
-        I,Index = dynamicProgramingSegmentation(points, Ns, delta)
-        mdl = MinimumDescriptionLength(points, Index, Ns)
+        with metrics.timer('dynamicProgramingSegmentation', trip=trip_id):
+            I,Index = dynamicProgramingSegmentation(points, Ns, delta)
+        with metrics.timer('MinimumDescriptionLength', trip=trip_id):
+            mdl = MinimumDescriptionLength(points, Index, Ns)
+        metrics.count('dp_cells', len(points) + sum(max(0, len(points)-2*k-1) for k in range(1, Ns)), trip=trip_id)
         if mdl < MDL:
             MDL = mdl
             bestNs = Ns
             optimizedIndex = Index
-        print ('.', end='')
-    print (' completed in {:.1f} sec!'.format(time.time() - start))
+    metrics.set('Ns', bestNs, trip=trip_id)
     
     # 3. Using optimize I and Index to get the optimal segment boundaries
     segmentPoints = set()
     lastEndPoint = len(points)-1
     for k in reversed(range(bestNs)):
-        segmentPoints.add(optimizedIndex[k][lastEndPoint])
+        segmentPoints.add(int(optimizedIndex[k][lastEndPoint]))
         lastEndPoint = optimizedIndex[k][lastEndPoint] - 1
-        
-    for i in range(0, len(trip_points)):
-        if i in segmentPoints:
-            writer.write('{},{},{},{},{},{},{},{},{}\n'.format(trip_id, 
-                                                       trip_points[i].time_step,
-                                                      trip_points[i].speed,
-                                                      trip_points[i].acceleration,
-                                                      trip_points[i].heading,
-                                                      trip_points[i].lat,
-                                                      trip_points[i].lng,
-                                                      trip_points[i].pmd,
-                                                      1))
-        else:
-            writer.write('{},{},{},{},{},{},{},{},{}\n'.format(trip_id, 
-                                                       trip_points[i].time_step,
-                                                      trip_points[i].speed,
-                                                      trip_points[i].acceleration,
-                                                      trip_points[i].heading,
-                                                      trip_points[i].lat,
-                                                      trip_points[i].lng,
-                                                      trip_points[i].pmd,
-                                                      0))
-            
-
-
-writer = open('output/segmentation_results.csv', 'w')
-writer.write('TripId,TimeStep,Speed,Acceleration,HeadingChange,Latitude,Longitude,PMD,StartOfSegment\n')
-max_number_of_segments = 50
-n_trajectories = 0
-
-path = r'C:\Users\sobhan\workspace\TrajectorySegmentation'
-with open('prerequisiteFiles/ProbabilisticDissimilarities.csv', 'r') as reader:
-    header = True
-    trip_id = ''
-    points = [] # for probability dissimilarity values
-    trip_points = [] # for all trip points
-    
-    for line in reader:
-        if header:
-            header = False
-            continue
-        parts = line.replace('\r','').replace('\n','').split(',') # TripId,TimeStep,ProbDissimilarity,Lat,Lng,Speed,Acceleration,Heading
-        if parts[0] == trip_id:
+
+    return sorted(segmentPoints), bestNs
+
+def segmentation_process(trip_id, # trip id
+                         points,  # contains probabilistic dissimilarity values
+                         trip_points, # contains trip points
+                         max_number_of_segments, # the maximum number of segments that we allow
+                         writer, # writer to print output 
+                         cache=None, # optional SegmentationCache, to reuse the segmentation of an unchanged trip
+                         strategy='exact', # 'exact', or 'windowed' to segment long trips in overlapping windows
+                         window_size=300, # number of points of a window, in windowed strategy
+                         overlap=100 # number of points shared by consecutive windows, in windowed strategy
+                        ):
+    cached = None
+    if cache is not None:
+        key = segmentation_cache_key(cache, points, max_number_of_segments, strategy, window_size, overlap)
+        cached = cache.get(key)
+
+    if cached is not None:
+        metrics.count('cache_hits')
+        segmentPoints, bestNs = cached
+    else:
+        segmentPoints, bestNs = segment_trip_by_strategy(trip_id, points, max_number_of_segments, strategy, window_size, overlap)
+        if cache is not None:
+            cache.put(key, segmentPoints, bestNs)
+
+    write_segmentation(trip_id, trip_points, segmentPoints, writer)
+
+def segment_trips(trips, # list of (trip id, probabilistic dissimilarity values)
+                  max_number_of_segments, # the maximum number of segments that we allow
+                  cache=None, # optional SegmentationCache, to reuse the segmentation of an unchanged trip
+                  batch_max_length=300, # longer trips are segmented one by one
+                  strategy='exact', # see segmentation_process
+                  window_size=300,
+                  overlap=100
+                 ):
+    # returns the sorted start points of the segments and the chosen number of segments of every trip, in order
+    keys, results = lookup_segmentations(trips, max_number_of_segments, cache, strategy, window_size, overlap)
+    missing = [i for i in range(len(trips)) if results[i] is None]
+    computed = compute_segmentations([trips[i] for i in missing], max_number_of_segments, batch_max_length, strategy, window_size, overlap)
+    for i, result in zip(missing, computed):
+        results[i] = result
+        if cache is not None:
+            cache.put(keys[i], *result)
+    return results
+
+def compute_segmentations(trips, max_number_of_segments, batch_max_length=300, strategy='exact', window_size=300, overlap=100):
+    # segments trips (without cache). Trips of 2*max_number_of_segments to batch_max_length points are segmented in batches ...
+    # ... with segment_trip_batch (which gives the same result as segment_trip), the others one by one with the given strategy
+    if strategy == 'windowed':
+        batch_max_length = min(batch_max_length, window_size) # longer trips are segmented in windows
+    results = [None] * len(trips)
+    for batch in length_batches([len(points) for _, points in trips], 2*max_number_of_segments, batch_max_length):
+        for i, result in zip(batch, segment_trip_batch([trips[i][1] for i in batch], max_number_of_segments)):
+            metrics.set('Ns', result[1], trip=trips[i][0])
+            results[i] = result
+
+    for i, (trip_id, points) in enumerate(trips):
+        if results[i] is None:
+            results[i] = segment_trip_by_strategy(trip_id, points, max_number_of_segments, strategy, window_size, overlap)
+    return results
+
+def lookup_segmentations(trips, max_number_of_segments, cache, strategy='exact', window_size=300, overlap=100):
+    # returns the cache keys and the cached segmentations (None for the trips which are not in the cache) of trips
+    if cache is None:
+        return [None] * len(trips), [None] * len(trips)
+    keys = [segmentation_cache_key(cache, points, max_number_of_segments, strategy, window_size, overlap) for _, points in trips]
+    results = [cache.get(key) for key in keys]
+    for result in results:
+        if result is not None:
+            metrics.count('cache_hits')
+    return keys, results
+
+def segmentation_cache_key(cache, points, max_number_of_segments, strategy='exact', window_size=300, overlap=100):
+    parameters = {'max_number_of_segments': max_number_of_segments, 'strategy': strategy}
+    if strategy == 'windowed':
+        parameters.update(window_size=window_size, overlap=overlap)
+    return cache.key(points, parameters)
+
+def write_segmentation(trip_id, trip_points, segmentPoints, writer):
+    startOfSegment = np.zeros(len(trip_points), dtype=int)
+    startOfSegment[[i for i in segmentPoints if 0 <= i < len(trip_points)]] = 1
+    writer.write_trip(trip_id, [[p.time_step for p in trip_points],
+                                [p.speed for p in trip_points],
+                                [p.acceleration for p in trip_points],
+                                [p.heading for p in trip_points],
+                                [p.lat for p in trip_points],
+                                [p.lng for p in trip_points],
+                                [p.pmd for p in trip_points],
+                                startOfSegment])
+
+
+# ### Reading Transformed Trajectories
+
+def read_trips(input_format='csv'):
+    # yields trip id, probabilistic dissimilarity values and trip points of every trip in ProbabilisticDissimilarities.csv ...
+    # ... or, if input_format is 'columnar', in its binary columnar version ProbabilisticDissimilarities.cols
+    if input_format == 'columnar':
+        reader = ColumnarReader(columnar_path('prerequisiteFiles/ProbabilisticDissimilarities.csv'))
+        for trip_id, columns in reader:
+            points = columns['ProbDissimilarity'].tolist()
+            trip_points = [trip_tuple(*values) for values in zip(columns['TimeStep'].tolist(),
+                                                                 columns['Speed'].tolist(),
+                                                                 columns['Acceleration'].tolist(),
+                                                                 columns['Heading'].tolist(),
+                                                                 columns['Lat'].tolist(),
+                                                                 columns['Lng'].tolist(),
+                                                                 points)]
+            metrics.count('rows_parsed', len(points))
+            yield trip_id, points, trip_points
+        return
+
+    with open('prerequisiteFiles/ProbabilisticDissimilarities.csv', 'r') as reader:
+        header = True
+        trip_id = ''
+        points = [] # for probability dissimilarity values
+        trip_points = [] # for all trip points
+
+        for line in reader:
+            if header:
+                header = False
+                continue
+            parts = line.replace('\r','').replace('\n','').split(',') # TripId,TimeStep,ProbDissimilarity,Lat,Lng,Speed,Acceleration,Heading
+            if parts[0] != trip_id:
+                if trip_id != '':
+                    metrics.count('rows_parsed', len(points))
+                    yield trip_id, points, trip_points
+                trip_id = parts[0]
+                points = []
+                trip_points = []
             points.append(float(parts[2]))
             trip_points.append(trip_tuple(parts[1], # time step
-                                         parts[5], # speed
-                                         parts[6], # acceleration
-                                         parts[7], # heading change
-                                         parts[3], #latitude
-                                         parts[4], #longitude
-                                         parts[2] # pmd
-                                ))
+                                          parts[5], # speed
+                                          parts[6], # acceleration
+                                          parts[7], # heading change
+                                          parts[3], #latitude
+                                          parts[4], #longitude
+                                          parts[2] # pmd
+                               ))
+
+    # the last trajectory
+    if trip_id != '':
+        metrics.count('rows_parsed', len(points))
+        yield trip_id, points, trip_points
+
+
+# ### Segmentation Workflow for All Trajectories
+
+def segment_all_trips(max_number_of_segments, input_format='csv', output_format='csv', cache=None, batched=False, chunk_size=1000,
+                      strategy='exact', window_size=300, overlap=100, executor=None, workers=None, queue_depth=8):
+    # strategy, window_size and overlap are described in segmentation_process
+    # when batched is True, trips are taken in chunks of chunk_size trips and the short trips of a chunk are segmented in ...
+    # ... batches (see compute_segmentations); the output is the same, in the same order
+    # when executor is 'thread' or 'process', parsing, segmentation and writing run at the same time (see Pipeline.py) ...
+    # ... with at most queue_depth chunks (or trips, if not batched) in flight; the output is the same, in the same order
+    writer = open_trip_writer('output/segmentation_results.csv', SEGMENTATION_LAYOUT, output_format)
+    n_trajectories = 0
+    start = time.time()
+    trips = read_trips(input_format)
+    if batched or executor is not None:
+        # the parser stage looks up the cache and the writer stage adds new entries, so the compute stage has no shared state
+        compute = functools.partial(compute_segmentations, max_number_of_segments=max_number_of_segments,
+                                    batch_max_length=300 if batched else 0,
+                                    strategy=strategy, window_size=window_size, overlap=overlap)
+        tasks = segmentation_tasks(trips, chunk_size if batched else 1, max_number_of_segments, cache, strategy, window_size, overlap)
+        missing = lambda task: ([(trip_id, points) for (trip_id, points, _), result in zip(task[0], task[2]) if result is None],)
+        for (chunk, keys, results), computed in pipelined(tasks, compute, missing, executor, workers, queue_depth):
+            computed = iter(computed)
+            for i, (trip_id, _, trip_points) in enumerate(chunk):
+                if results[i] is None:
+                    results[i] = next(computed)
+                    if cache is not None:
+                        cache.put(keys[i], *results[i])
+                write_segmentation(trip_id, trip_points, results[i][0], writer)
+            n_trajectories += len(chunk)
+    else:
+        for trip_id, points, trip_points in trips:
+            # do segmentation
+            with metrics.timer('segmentation_process', trip=trip_id):
+                segmentation_process(trip_id, points, trip_points, max_number_of_segments, writer, cache, strategy, window_size, overlap)
+            n_trajectories += 1
+    writer.close()
+    print ('\nDone with segmentation of {} trajectories in {:.1f} sec!'.format(n_trajectories, time.time() - start))
+    if cache is not None:
+        cache.report()
+
+def segmentation_tasks(trips, chunk_size, max_number_of_segments, cache, strategy='exact', window_size=300, overlap=100):
+    # yields chunks of chunk_size trips, with their cache keys and cached segmentations (see lookup_segmentations)
+    while True:
+        chunk = list(itertools.islice(trips, chunk_size))
+        if not chunk:
+            return
+        keys, results = lookup_segmentations([(trip_id, points) for trip_id, points, _ in chunk], max_number_of_segments, cache,
+                                             strategy, window_size, overlap)
+        yield chunk, keys, results
+
+
+# ### Agreement of Windowed and Exact Segmentation
+
+def matched_boundaries(exact, windowed, tolerance):
+    # number of boundaries of windowed which are at most tolerance points away from a distinct boundary of exact
+    matched = 0
+    i = j = 0
+    while i < len(exact) and j < len(windowed):
+        if abs(exact[i] - windowed[j]) <= tolerance:
+            matched += 1
+            i += 1
+            j += 1
+        elif windowed[j] < exact[i]:
+            j += 1
         else:
-            if trip_id != '':
-                # do segmentation
-                segmentation_process(trip_id, points, trip_points, max_number_of_segments, writer)
-                n_trajectories += 1
-            trip_id = parts[0]
-            points = [float(parts[2])]
-            trip_points = [trip_tuple(parts[1], # time step
-                                         parts[5], # speed
-                                         parts[6], # acceleration
-                                         parts[7], # heading change
-                                         parts[3], #latitude
-                                         parts[4], #longitude
-                                         parts[2] # pmd
-                                )
-                ]
-        
-    
-# do segmentation for the last trajectory
-segmentation_process(trip_id, points, trip_points, max_number_of_segments, writer)
-n_trajectories += 1
-writer.close()   
-print ('\nDone with segmentation of {} trajectories!'.format(n_trajectories))
+            i += 1
+    return matched
+
+def report_windowed_agreement(max_number_of_segments, window_size=300, overlap=100, max_length=900, tolerance=2, input_format='csv'):
+    # compares windowed segmentation against exact segmentation on the trips where both are feasible, i.e. which are ...
+    # ... longer than a window but have at most max_length points
+    trips = [(trip_id, points) for trip_id, points, _ in read_trips(input_format) if window_size < len(points) <= max_length]
+    if not trips:
+        print ('No trip of {} to {} points to compare windowed and exact segmentation'.format(window_size+1, max_length))
+        return
+
+    start = time.time()
+    exact = segment_trips(trips, max_number_of_segments, batch_max_length=max_length)
+    exactTime = time.time() - start
+    start = time.time()
+    windowed = [segment_trip_windowed(trip_id, points, max_number_of_segments, window_size, overlap) for trip_id, points in trips]
+    windowedTime = time.time() - start
+
+    # the start of a trip is always a boundary, so only the other boundaries are compared
+    exactBoundaries = [e[1:] for e, _ in exact]
+    windowedBoundaries = [w[1:] for w, _ in windowed]
+    matched = sum(matched_boundaries(e, w, tolerance) for e, w in zip(exactBoundaries, windowedBoundaries))
+    nExact = sum(len(e) for e in exactBoundaries)
+    nWindowed = sum(len(w) for w in windowedBoundaries)
+
+    print ('Windowed (window_size={}, overlap={}) against exact segmentation over {} trips of {} to {} points:'.format(
+        window_size, overlap, len(trips), min(len(p) for _, p in trips), max(len(p) for _, p in trips)))
+    print ('  identical segmentations: {} of {}'.format(sum(e == w for e, w in zip(exact, windowed)), len(trips)))
+    print ('  boundaries:              {} exact, {} windowed, {} matched within {} points'.format(nExact, nWindowed, matched, tolerance))
+    print ('  precision / recall:      {:.3f} / {:.3f}'.format(float(matched) / max(nWindowed, 1), float(matched) / max(nExact, 1)))
+    print ('  mean |Ns difference|:    {:.2f}'.format(np.mean([abs(e[1] - w[1]) for e, w in zip(exact, windowed)])))
+    print ('  segmentation time:       {:.1f} sec exact, {:.1f} sec windowed'.format(exactTime, windowedTime))
+
+
+if __name__ == '__main__':
+    max_number_of_segments = 50
+    input_format = 'csv'  # set to 'columnar' to read prerequisiteFiles/ProbabilisticDissimilarities.cols
+    output_format = 'csv' # set to 'columnar' to write output/segmentation_results.cols (see Columnar_Format.py)
+    batched = False       # set to True to segment short trips (up to 300 points) in batches, with the same results
+    strategy = 'exact'    # set to 'windowed' to segment trips longer than window_size in overlapping windows
+    window_size = 300     # number of points of a window (at least 2*max_number_of_segments)
+    overlap = 100         # number of points shared by consecutive windows (at least 2)
+    report_agreement = False # set to True to report boundary agreement of windowed and exact segmentation
+    executor = None       # set to 'thread' or 'process' to overlap parsing, segmentation and writing (see Pipeline.py)
+    workers = None        # number of threads or processes segmenting trips at the same time
+    use_cache = False     # set to True to reuse segmentation of unchanged trips from prerequisiteFiles/segmentation_cache
+    cache_size = 64 << 20 # maximum size of the cache in bytes
+    metrics_file = None   # set (e.g. 'output/segmentation_metrics.json') to write timers and counters of the run (see Instrumentation.py)
+    profile_file = None   # set to profile the run, with the profiler below
+    profiler = 'cprofile' # 'cprofile' or 'sampling'
+
+    if report_agreement:
+        report_windowed_agreement(max_number_of_segments, window_size, overlap, input_format=input_format)
+    else:
+        cache = SegmentationCache(max_size=cache_size) if use_cache else None
+        run_instrumented(lambda: segment_all_trips(max_number_of_segments, input_format, output_format, cache, batched,
+                                                   strategy=strategy, window_size=window_size, overlap=overlap,
+                                                   executor=executor, workers=workers),
+                         metrics_file, profile_file, profiler)
 
 
 # ### Notes
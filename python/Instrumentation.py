@@ -0,0 +1,160 @@
+# ## What Does This Script Do?
+
+# This script provides the instrumentation shared by `Building_Graph.py`, `Trajectory_Transformation.py` and
+# `Dynamic_Programming_Segmentation.py`: timers and counters per stage and per trip, written as a json metrics file,
+# plus optional profiling of a run (with cProfile, or with a sampling profiler which has lower overhead).
+#
+# Instrumentation is disabled by default; all the calls on the shared `metrics` object then return immediately, so it
+# costs close to nothing. It is enabled with `metrics.enable()`, e.g.:
+#
+#     from Instrumentation import metrics
+#     metrics.enable()
+#     with metrics.timer('calculateDelta', trip=trip_id):
+#         delta = calculateDelta(points)
+#     metrics.count('delta_cells', len(points) * (len(points)-1) // 2, trip=trip_id)
+#     metrics.dump('output/metrics.json')
+
+import collections
+import contextlib
+import cProfile
+import json
+import sys
+import threading
+import time
+
+
+class Timer:
+    def __init__(self, metrics, stage, trip):
+        self.metrics = metrics
+        self.stage = stage
+        self.trip = trip
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.metrics.add_time(self.stage, time.perf_counter() - self.start, self.trip)
+
+class Metrics:
+    def __init__(self):
+        self.enabled = False
+        self.disabled_timer = contextlib.nullcontext()
+        self.lock = threading.Lock() # metrics can be updated by the threads of a pipeline (see Pipeline.py)
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        self.stages = {}
+        self.counters = {}
+        self.trips = {}
+
+    def trip_metrics(self, trip):
+        if trip not in self.trips:
+            self.trips[trip] = {'stages': {}, 'counters': {}}
+        return self.trips[trip]
+
+    def timer(self, stage, trip=None):
+        # context manager which adds the time spent inside it to the stage (and to the stage of the trip, if any)
+        if not self.enabled:
+            return self.disabled_timer
+        return Timer(self, stage, trip)
+
+    def add_time(self, stage, seconds, trip=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            for stages in ((self.stages,) if trip is None else (self.stages, self.trip_metrics(trip)['stages'])):
+                if stage not in stages:
+                    stages[stage] = {'seconds': 0.0, 'calls': 0}
+                stages[stage]['seconds'] += seconds
+                stages[stage]['calls'] += 1
+
+    def count(self, name, value=1, trip=None):
+        # adds value to a counter (totals over all trips are kept as well)
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if trip is not None:
+                counters = self.trip_metrics(trip)['counters']
+                counters[name] = counters.get(name, 0) + value
+
+    def set(self, name, value, trip=None):
+        # records a value which is not summed up, e.g. the chosen number of segments of a trip
+        if not self.enabled:
+            return
+        with self.lock:
+            if trip is None:
+                self.counters[name] = value
+            else:
+                self.trip_metrics(trip)['counters'][name] = value
+
+    def dump(self, output_file):
+        with open(output_file, 'w') as writer:
+            json.dump({'stages': self.stages, 'counters': self.counters, 'trips': self.trips}, writer, indent=1)
+
+metrics = Metrics()
+
+
+# ### Profiling Hooks
+
+class SamplingProfiler:
+    # samples the stack of the profiled thread every `interval` seconds; the output has one line per distinct stack ...
+    # ... in the collapsed format used by flame graph tools: 'outer;inner;innermost count'
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.samples = collections.Counter()
+
+    def run(self, thread_id, stop):
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            stack = []
+            while frame is not None:
+                stack.append('{}:{}'.format(frame.f_code.co_filename.split('/')[-1], frame.f_code.co_name))
+                frame = frame.f_back
+            self.samples[';'.join(reversed(stack))] += 1
+
+    def dump(self, output_file):
+        with open(output_file, 'w') as writer:
+            for stack, count in self.samples.most_common():
+                writer.write('{} {}\n'.format(stack, count))
+
+@contextlib.contextmanager
+def profile(output_file, profiler='cprofile', interval=0.005):
+    # profiles the code inside the context; profiler is 'cprofile' (stats for pstats/snakeviz) or 'sampling'
+    if profiler == 'sampling':
+        sampler = SamplingProfiler(interval)
+        stop = threading.Event()
+        thread = threading.Thread(target=sampler.run, args=(threading.get_ident(), stop), daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+            sampler.dump(output_file)
+    else:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(output_file)
+
+def run_instrumented(function, metrics_file=None, profile_file=None, profiler='cprofile'):
+    # runs function, with metrics enabled if metrics_file is given and with profiling if profile_file is given
+    if metrics_file is not None:
+        metrics.enable()
+    with profile(profile_file, profiler) if profile_file is not None else contextlib.nullcontext():
+        result = function()
+    if metrics_file is not None:
+        metrics.dump(metrics_file)
+        print ('Metrics are written to {}'.format(metrics_file))
+    return result
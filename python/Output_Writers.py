@@ -0,0 +1,65 @@
+# ## What Does This Script Do?
+
+# This script provides the output layer shared by `Building_Graph.py`, `Trajectory_Transformation.py` and `Dynamic_Programming_Segmentation.py`.
+# Instead of formatting and writing one row at a time, rows are formatted in blocks (e.g. a whole trip) from column arrays,
+# and the formatted text is written to the output file in large chunks. The text of each row is the same as
+# `row_format.format(...)` applied to the row values, so output files do not change.
+
+import itertools
+from collections.abc import Iterator
+import numpy as np
+
+
+class BufferedCsvWriter:
+    def __init__(self, output_file, header=None, buffer_size=1 << 22):
+        self.writer = open(output_file, 'w')
+        self.buffer = []
+        self.buffered = 0
+        self.buffer_size = buffer_size # number of characters to collect before writing them to the file
+        self.slice_rows = 1024 # number of rows formatted at a time by write_rows
+        if header is not None:
+            self.write(header)
+
+    def write(self, text):
+        self.buffer.append(text)
+        self.buffered += len(text)
+        if self.buffered >= self.buffer_size:
+            self.flush()
+
+    def write_rows(self, row_format, *columns):
+        # each column is either a sequence (list or numpy array) or an iterator with one value per row, or a single value ...
+        # ... shared by all rows; at least one column must not be a single value.
+        # Rows are formatted in slices of about buffer_size characters, so a large block (e.g. a whole graph) is never ...
+        # ... held in memory as text
+        columns = [iter(as_column(c)) for c in columns]
+        while True:
+            text = ''.join(map(row_format.format, *[itertools.islice(c, self.slice_rows) for c in columns]))
+            if not text:
+                break
+            self.write(text)
+            # rows of the next slices, from the length of the rows of this one
+            self.slice_rows = max(1, self.buffer_size * text.count('\n') // len(text))
+
+    def flush(self):
+        if self.buffer:
+            self.writer.write(''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def as_column(values, chunk_size=1 << 16):
+    if isinstance(values, np.ndarray):
+        # python scalars are formatted the same way as values written by the original scripts; converted a chunk at a time
+        return itertools.chain.from_iterable(values[i:i + chunk_size].tolist() for i in range(0, len(values), chunk_size))
+    if isinstance(values, (list, tuple, range, Iterator)):
+        return values
+    return itertools.repeat(values)
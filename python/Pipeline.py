@@ -0,0 +1,86 @@
+# ## What Does This Script Do?
+
+# This script provides the pipelined executor shared by `Trajectory_Transformation.py` and `Dynamic_Programming_Segmentation.py`.
+# Instead of reading a trip, computing its result and writing it before reading the next trip, three stages run at the same time:
+# * parser: a thread which takes the items (e.g. trips) from an iterator, so reading and parsing the input file happen here, ...
+#   ... and submits them to the compute stage
+# * compute: a pool of threads (for functions which spend their time in numpy, and release the GIL) or of processes ...
+#   ... (for pure python functions); the function and its arguments must be picklable to use processes
+# * writer: the caller, which gets the (item, result) pairs in the order of the items, e.g. to write them to the output file
+#
+# The parser stage waits when queue_depth items are waiting for the writer stage, so memory is bounded by the queue depth ...
+# ... whatever the speed of the stages. E.g.:
+#
+#     for (trip_id, points), result in pipelined(read_trips(), segment, lambda trip: (trip[1],), executor='process'):
+#         writer.write_trip(trip_id, ...)
+#
+# Note that timers and counters of `Instrumentation.py` updated inside worker processes are not collected.
+
+import concurrent.futures
+import queue
+import threading
+
+
+end_of_items = object()
+
+def put(pending, entry, stop):
+    # puts entry in the bounded queue, unless the writer stage stopped meanwhile; returns whether entry was put
+    while not stop.is_set():
+        try:
+            pending.put(entry, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def pipelined(items, # iterable of items, consumed by the parser stage
+              compute, # function called in the compute stage
+              inputs=None, # function giving the arguments of compute for an item (by default, the item itself)
+              executor='thread', # 'thread' or 'process' pool for the compute stage, or None to run all the stages in turn
+              workers=None, # number of threads or processes of the pool (by default, as many as the pool decides)
+              queue_depth=16, # maximum number of items between the parser and the writer stages
+              initializer=None, # optional function called once in every worker, e.g. to load data shared by all the items
+              initargs=()
+             ):
+    # yields (item, compute(*inputs(item))) for every item, in the order of items
+    if inputs is None:
+        inputs = lambda item: (item,)
+
+    if executor is None:
+        if initializer is not None:
+            initializer(*initargs)
+        for item in items:
+            yield item, compute(*inputs(item))
+        return
+
+    if executor == 'process':
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    else:
+        pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs)
+    pending = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+
+    def parse():
+        try:
+            for item in items:
+                if not put(pending, (item, pool.submit(compute, *inputs(item))), stop):
+                    return
+            put(pending, (end_of_items, None), stop)
+        except BaseException as error: # given to the writer stage, which raises it
+            put(pending, (end_of_items, error), stop)
+
+    parser = threading.Thread(target=parse, daemon=True)
+    parser.start()
+    try:
+        while True:
+            item, future = pending.get()
+            if item is end_of_items:
+                if future is not None:
+                    raise future
+                break
+            yield item, future.result()
+    finally:
+        # stop the parser stage and drop the pending work, e.g. when the writer stage failed
+        stop.set()
+        parser.join()
+        pool.shutdown(wait=True, cancel_futures=True)
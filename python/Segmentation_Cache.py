@@ -0,0 +1,78 @@
+# ## What Does This Script Do?
+
+# This script provides an on-disk cache for the result of segmenting a trip, so that trips which did not change since the
+# last run are not segmented again by `Dynamic_Programming_Segmentation.py`.
+#
+# An entry is addressed by a hash of the PMD signal of the trip plus the segmentation parameters (`max_number_of_segments`,
+# strategy, ...), and holds the start points of the segments and the chosen number of segments (Ns). Entries are small json
+# files inside the cache directory. When the total size of the cache exceeds `max_size` bytes, the least recently used
+# entries are evicted.
+
+import hashlib
+import json
+import os
+import numpy as np
+
+
+class SegmentationCache:
+    version = 1 # change it when the segmentation algorithm changes, to invalidate all the existing entries
+
+    def __init__(self, path='prerequisiteFiles/segmentation_cache', max_size=64 << 20):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def key(self, points, parameters):
+        h = hashlib.sha256()
+        h.update(np.asarray(points, dtype='<f8').tobytes())
+        h.update(json.dumps(dict(parameters, version=self.version), sort_keys=True).encode('utf-8'))
+        return h.hexdigest()
+
+    def get(self, key):
+        # returns (segment start points, Ns) if the key is in the cache, otherwise None
+        entry = os.path.join(self.path, key + '.json')
+        try:
+            with open(entry, 'r') as reader:
+                value = json.load(reader)
+            os.utime(entry) # last access time, for eviction
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return value['segment_points'], value['Ns']
+
+    def put(self, key, segment_points, Ns):
+        entry = os.path.join(self.path, key + '.json')
+        temp = entry + '.tmp'
+        with open(temp, 'w') as writer:
+            json.dump({'segment_points': [int(p) for p in segment_points], 'Ns': int(Ns)}, writer)
+        if os.path.exists(entry):
+            self.size -= os.path.getsize(entry)
+        os.replace(temp, entry)
+        self.size += os.path.getsize(entry)
+
+        if self.size > self.max_size:
+            self.evict()
+
+    def evict(self):
+        # remove least recently used entries until the cache takes at most 90% of max_size
+        entries = sorted(self.entries(), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries:
+            if self.size <= 0.9 * self.max_size:
+                break
+            self.size -= entry.stat().st_size
+            os.remove(entry.path)
+
+    def entries(self):
+        return [entry for entry in os.scandir(self.path) if entry.name.endswith('.json')]
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total else 0.0
+
+    def report(self):
+        print ('Segmentation cache: {} hits, {} misses (hit rate {:.1f}%), {} entries, {:.1f} KB'.format(
+            self.hits, self.misses, 100.0 * self.hit_rate(), len(self.entries()), self.size / 1024.0))
@@ -13,8 +13,10 @@
 # * `Longitude`: longitude coordinate of GPS (a float)
 # 
 # Intput data must be specified in terms of a single csv file named as `segmentation_trips.csv`, and the input file must be placed inside `/data` directory. 
+# Trips are read one at a time, so all the records of a trip must be contiguous in the file (otherwise a `ValueError` is raised).
 # 
-# __Output__: this notebook generates a single `csv` file named as `ProbabilisticDissimilarities.csv` which will be written inside the `/prerequisiteFiles` folder. This file includes the following attributes:
+# __Output__: this notebook generates a single `csv` file named as `ProbabilisticDissimilarities.csv` which will be written inside the `/prerequisiteFiles` folder
+# (or, with `output_format = 'columnar'`, the binary columnar dataset `ProbabilisticDissimilarities.cols` described in `Columnar_Format.py`). This file includes the following attributes:
 # * `TripId`: id of trajectory (a string)
 # * `TimeStep`: time step identifier for a record of a trajectory (an integer)
 # * `ProbDissimilarity`: probability dissimilarity value for the current record of a trajectory (a float). This is the signal value for a record. 
@@ -26,6 +28,12 @@
 
 
 import numpy as np
+import time
+
+from Building_Graph import load_transition_graph, prune_transition_graph
+from Columnar_Format import PMD_LAYOUT, open_trip_writer
+from Instrumentation import metrics, run_instrumented
+from Pipeline import pipelined
 
 
 # ### Load Trajectory Data
@@ -40,34 +48,41 @@ class tripTuple:
         self.time_step = time_step
 
 def load_trajectory_data():
-
-    reader = open('data/segmentation_trips.csv', 'r')
-    tripData = {}
-
-
-    header = True
-    for line in reader:
-        if header:
-            header = False
-            continue
-
-        try:
-            # TripId,Time_Step,Speed(km/h),Acceleration(m/s^2),Heading_Change(degrees),Latitude,Longitude
-            parts = line.replace('\r','').replace('\n','').split(',')
-
-            tr = tripTuple(int(parts[1]), float(parts[2]), float(parts[3]), float(parts[4]),
-                          float(parts[5]), float(parts[6]))
-
-            lst = []
-            if parts[0] in tripData:
-                lst = tripData[parts[0]]
-            lst.append(tr)
-            tripData[parts[0]] = lst
-
-        except:
-            pass
-    
-    return tripData
+    # yields trip id and points of every trip in segmentation_trips.csv, one trip at a time; rows of a trip must be contiguous
+    with open('data/segmentation_trips.csv', 'r') as reader:
+        header = True
+        trip_id = None
+        points = []
+        yielded = set() # ids of the trips already yielded
+        for line in reader:
+            if header:
+                header = False
+                continue
+
+            try:
+                # TripId,Time_Step,Speed(km/h),Acceleration(m/s^2),Heading_Change(degrees),Latitude,Longitude
+                parts = line.replace('\r','').replace('\n','').split(',')
+
+                tr = tripTuple(int(parts[1]), float(parts[2]), float(parts[3]), float(parts[4]),
+                              float(parts[5]), float(parts[6]))
+            except:
+                continue
+
+            if parts[0] != trip_id:
+                if trip_id is not None:
+                    metrics.count('rows_parsed', len(points))
+                    yield trip_id, points
+                    yielded.add(trip_id)
+                if parts[0] in yielded:
+                    raise ValueError('rows of trip {} are not contiguous in data/segmentation_trips.csv'.format(parts[0]))
+                trip_id = parts[0]
+                points = []
+            points.append(tr)
+
+    # the last trip
+    if trip_id is not None:
+        metrics.count('rows_parsed', len(points))
+        yield trip_id, points
 
 
 # ### Calculate Probabilistic Distance
@@ -121,114 +136,174 @@ def getProbabilisticDistance(crntState, prevState, transProb, totalCounter):
     
     return distance, totalCounter
 
-def compute_probabilistic_dissimilarities():
-    
-    zeroCounter  = 0
-    totalCounter = 0
-    avgTransProb = 0   # this value will be used for missing transition probability; i.e. for those with 0 prob.
-    
-    # load trip data
-    tripData = load_trajectory_data()
+def load_transition_probabilities(top_k=None, mass_threshold=None):
+    # Load State Transition Probability; the graph can be pruned at load time to bound the cost of PMD for a record
+    graph = prune_transition_graph(load_transition_graph('prerequisiteFiles/probsRegularized.csv'), top_k, mass_threshold)
+    labels = graph.state_labels()
 
-    # Load State Transition Probability
+    avgTransProb = 0   # this value will be used for missing transition probability; i.e. for those with 0 prob.
     transProb = {}
     count = 0
-    with open('prerequisiteFiles/probsRegularized.csv', 'r') as reader:
-        for line in reader:
-            parts = line.replace('\r','').replace('\n','').split(',')
-            prob = float(parts[2])
-            avgTransProb += prob
-            count += 1
+    for s1, s2, prob in zip(graph.src.tolist(), graph.dst.tolist(), graph.values.tolist()):
+        avgTransProb += prob
+        count += 1
 
-            trans = {}
-            if parts[0] in transProb:
-                trans = transProb[parts[0]]
-            trans[parts[1]] = prob
-            transProb[parts[0]] = trans
+        trans = {}
+        if labels[s1] in transProb:
+            trans = transProb[labels[s1]]
+        trans[labels[s2]] = prob
+        transProb[labels[s1]] = trans
 
     avgTransProb /= count
+    return transProb, avgTransProb
+
+def get_state(point):
+    return '{}&{}&{}'.format(int(point.speed), int(np.round(point.acceleration*.25))/.25, int(point.heading))
+
+def transform_trip(trip_points, transProb, avgTransProb):
+    # returns probabilistic dissimilarity of every record of a trip, along with the number of fallbacks to avgTransProb ...
+    # ... and the number of records for which PMD was computed from the graph
+    zeroCounter = 0
+    totalCounter = 0
+    distances = [0.0]
+
+    prevState = get_state(trip_points[0])
+    for i in range(1, len(trip_points)):
+        crntState = get_state(trip_points[i])
+        distance = 0
+
+        if crntState != prevState:
+            if prevState in transProb:
+                distance,totalCounter = getProbabilisticDistance(crntState, prevState, transProb[prevState], totalCounter)
+            else:
+                zeroCounter += 1
+                distance = avgTransProb
+
+        distances.append(distance)
+        prevState = crntState
+
+    return distances, zeroCounter, totalCounter
+
+# transition probabilities used by transform_trip_with_graph, set once in every worker of the pipeline (see Pipeline.py)
+workerTransProb = None
+workerAvgTransProb = None
+
+def set_transition_probabilities(transProb, avgTransProb):
+    global workerTransProb, workerAvgTransProb
+    workerTransProb = transProb
+    workerAvgTransProb = avgTransProb
+
+def transform_trip_with_graph(trip, trip_points):
+    with metrics.timer('transform_trip', trip=trip):
+        return transform_trip(trip_points, workerTransProb, workerAvgTransProb)
+
+def compute_probabilistic_dissimilarities(top_k=None, mass_threshold=None, output_format='csv', executor=None, workers=None, queue_depth=64):
+    # when executor is 'thread' or 'process', trips are read and parsed, transformed by a pool of threads or processes, and ...
+    # ... written at the same time, with at most queue_depth trips in memory (see Pipeline.py); the output is the same, in the same order
+
+    zeroCounter  = 0
+    totalCounter = 0
+
+    # Load State Transition Probability
+    with metrics.timer('load_transition_probabilities'):
+        transProb, avgTransProb = load_transition_probabilities(top_k, mass_threshold)
+    metrics.count('graph_states', len(transProb))
     print ('Probability values are loaded!')
 
 
-    # specify output file
-    writer = open('prerequisiteFiles/ProbabilisticDissimilarities.csv', 'w')
+    # specify output file; 'columnar' writes prerequisiteFiles/ProbabilisticDissimilarities.cols instead
+    writer = open_trip_writer('prerequisiteFiles/ProbabilisticDissimilarities.csv', PMD_LAYOUT, output_format)
 
-    # set transition threshold 
+    # set transition threshold
     minLength = 1;
     # set Angle bin size
     angleBinSize = 1;
     # set top candidates for comparison
     numberOfTrips = 0;
 
-    writer.write('TripId,TimeStep,ProbDissimilarity,Lat,Lng,Speed,Acceleration,Heading\n')
-    for trip in tripData:
-        crntTripLength = len(tripData[trip])
-        down = 0
-        up = crntTripLength
-
-        if crntTripLength < minLength:
-            continue
+    # trip data is read one trip at a time, by the parser stage of the pipeline
+    trips = ((trip, points) for trip, points in load_trajectory_data() if len(points) >= minLength)
+    transformed = pipelined(trips, transform_trip_with_graph, lambda trip: trip, executor, workers, queue_depth,
+                            set_transition_probabilities, (transProb, avgTransProb))
+    for (trip, points), (distances, zeros, total) in transformed:
+        crntTripLength = len(points)
 
         ## get the most recent available heading values
         ## Why getting last heading? Currently, we use heading as values between 0 to 359. So, if have no GPS coordinates for some time ...
         ##  during trip, then we no longer can use 180. So, last heading gives the closest (time base closeness) available heading value to be used as an estimation
 
         numberOfTrips += 1
-        print ('Transforming {} of size {}'.format(trip, len(tripData[trip])))
-         
-        writer.write('{},{},{},{},{},{},{},{}\n'.format(
-            trip, 
-            tripData[trip][down].time_step, 
-            0.0,
-            tripData[trip][down].lat,
-            tripData[trip][down].lng,
-            tripData[trip][down].speed,
-            tripData[trip][down].acceleration,
-            tripData[trip][down].heading
-        ))
-        
-        prevState = '{}&{}&{}'.format(int(tripData[trip][down].speed), 
-                                        int(np.round(tripData[trip][down].acceleration*.25))/.25, 
-                                        int(tripData[trip][down].heading))
-
-        for i in range(down+1, up):
-            crntState = '{}&{}&{}'.format(int(tripData[trip][i].speed), 
-                                        int(np.round(tripData[trip][i].acceleration*.25))/.25, 
-                                        int(tripData[trip][i].heading))
-            distance = 0
-
-            if crntState != prevState:
-                if prevState in transProb:
-                    distance,totalCounter = getProbabilisticDistance(crntState, prevState, transProb[prevState], totalCounter)
-                else:
-                    zeroCounter += 1
-                    distance = avgTransProb
-
-            writer.write('{},{},{},{},{},{},{},{}\n'.format(
-                trip, 
-                tripData[trip][i].time_step, 
-                distance,
-                tripData[trip][i].lat,
-                tripData[trip][i].lng,
-                tripData[trip][i].speed,
-                tripData[trip][i].acceleration,
-                tripData[trip][i].heading
-            ))
-
-            prevState = crntState
+        metrics.count('records', crntTripLength, trip=trip)
+        metrics.count('pmd_fallbacks', zeros, trip=trip)   # zeroCounter: previous state is not in the graph
+        metrics.count('pmd_computed', total, trip=trip)    # totalCounter
+        zeroCounter += zeros
+        totalCounter += total
+
+        writer.write_trip(trip, [
+            [p.time_step for p in points],
+            distances,
+            [p.lat for p in points],
+            [p.lng for p in points],
+            [p.speed for p in points],
+            [p.acceleration for p in points],
+            [p.heading for p in points]
+        ])
 
     writer.close()
     print ('\nNumber of processed trips: ', numberOfTrips)
-    
+
     print ('\n% time that PMD was zero due to non existing states: {:.2f}'.format(float(zeroCounter*100.0/totalCounter)))
     print ('zeroCounter: {} \ntotalCounter: {}'.format(zeroCounter, totalCounter))
 
 
-# ### Transforming Trajectories to Probabilistic Dissimilarity Space (aka Generating Signals)
+# ### Approximation Error of PMD on a Pruned Graph
+
+def report_pmd_approximation_error(top_k=None, mass_threshold=None):
+    # compares PMD values obtained from the pruned graph against the ones from the full graph on the sample trips
+    fullProb, fullAvg = load_transition_probabilities()
+    prunedProb, prunedAvg = load_transition_probabilities(top_k, mass_threshold)
 
-compute_probabilistic_dissimilarities()
+    exact = []
+    approx = []
+    fullTime = 0
+    prunedTime = 0
+    for trip, points in load_trajectory_data():
+        start = time.time()
+        exact.extend(transform_trip(points, fullProb, fullAvg)[0])
+        fullTime += time.time() - start
 
+        start = time.time()
+        approx.extend(transform_trip(points, prunedProb, prunedAvg)[0])
+        prunedTime += time.time() - start
 
+    exact = np.array(exact, dtype=np.float64)
+    error = np.abs(np.array(approx, dtype=np.float64) - exact)
+    fullSuccessors = [len(trans) for trans in fullProb.values()]
+    prunedSuccessors = [len(trans) for trans in prunedProb.values()]
 
+    print ('PMD approximation error with top_k={} and mass_threshold={} over {} records:'.format(top_k, mass_threshold, len(exact)))
+    print ('  mean absolute error:     {:.6f}'.format(np.mean(error)))
+    print ('  max absolute error:      {:.6f}'.format(np.max(error)))
+    print ('  relative error:          {:.4f}%'.format(100.0 * np.sum(error) / np.sum(np.abs(exact))))
+    print ('  successors per state:    {:.1f} (max {}) on full graph, {:.1f} (max {}) on pruned graph'.format(
+        np.mean(fullSuccessors), np.max(fullSuccessors), np.mean(prunedSuccessors), np.max(prunedSuccessors)))
+    print ('  transformation time:     {:.1f} sec on full graph, {:.1f} sec on pruned graph'.format(fullTime, prunedTime))
 
 
+# ### Transforming Trajectories to Probabilistic Dissimilarity Space (aka Generating Signals)
+
+if __name__ == '__main__':
+    top_k = None                       # set to keep only the top k successors of each state when loading the graph
+    mass_threshold = None              # set (e.g. 0.95) to keep only successors which cover this probability mass of each state
+    report_approximation_error = False # set to True to report PMD error of the pruned graph against the full graph
+    output_format = 'csv'              # set to 'columnar' to write the binary columnar format (see Columnar_Format.py)
+    executor = None                    # set to 'process' (or 'thread') to transform trips in parallel with writing (see Pipeline.py)
+    workers = None                     # number of processes (or threads) transforming trips at the same time
+    metrics_file = None                # set (e.g. 'output/transformation_metrics.json') to write timers and counters of the run (see Instrumentation.py)
+    profile_file = None                # set to profile the run, with the profiler below
+    profiler = 'cprofile'              # 'cprofile' or 'sampling'
+
+    if report_approximation_error:
+        report_pmd_approximation_error(top_k, mass_threshold)
+    else:
+        run_instrumented(lambda: compute_probabilistic_dissimilarities(top_k, mass_threshold, output_format, executor, workers), metrics_file, profile_file, profiler)